@@ -0,0 +1,164 @@
+import json
+import os
+import gzip
+import hmac
+import secrets
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from datetime import date
+from itertools import groupby
+
+ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET', 'moonly-archive')
+ARCHIVE_PREFIX = 'archive/messages'
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+MESSAGES_HOT_MONTHS = int(os.environ.get('MESSAGES_HOT_MONTHS', '12'))
+PARTITIONS_AHEAD = 3
+PARTITIONS_PER_RUN = 1
+CLIENT_MSG_ID_RETENTION_DAYS = 7
+OUTBOX_RETENTION_HOURS = 24
+SESSION_RETENTION_DAYS = 7
+EXPORT_FETCH_SIZE = 5000
+
+def get_db_connection():
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+def get_s3_client():
+    import boto3
+    return boto3.client('s3',
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+    )
+
+def find_cold_partitions(cur) -> list:
+    '''Помесячные секции messages старше MESSAGES_HOT_MONTHS, от старых к новым'''
+    cur.execute("""
+        SELECT child.relname
+        FROM pg_inherits
+        INNER JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        INNER JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'messages' AND child.relname ~ '^messages_[0-9]{4}_[0-9]{2}$'
+        AND to_date(substring(child.relname from 10), 'YYYY_MM')
+            < date_trunc('month', CURRENT_TIMESTAMP) - %s * INTERVAL '1 month'
+        ORDER BY child.relname
+    """, (MESSAGES_HOT_MONTHS,))
+    return [row[0] for row in cur.fetchall()]
+
+def export_partition(conn, s3, partition: str) -> list:
+    '''Выгружает секцию в gzip JSON Lines, по объекту на чат; возвращает строки для message_archives'''
+    year, month = partition.split('_')[1:]
+    month_start = date(int(year), int(month), 1)
+    archives = []
+
+    with conn.cursor(name='archive_export') as cur:
+        cur.itersize = EXPORT_FETCH_SIZE
+        cur.execute(sql.SQL("""
+            SELECT chat_id, id, message_text, message_type, file_url, created_at, sender_id, file_preview
+            FROM {}
+            ORDER BY chat_id, id
+        """).format(sql.Identifier(partition)))
+
+        for chat_id, rows in groupby(cur, key=lambda row: row[0]):
+            records = [{
+                'id': row[1],
+                'text': row[2],
+                'type': row[3],
+                'file_url': row[4],
+                'created_at': row[5].isoformat(),
+                'sender_id': row[6],
+                'file_preview': row[7]
+            } for row in rows]
+
+            object_key = f'{ARCHIVE_PREFIX}/{year}_{month}/chat_{chat_id}_{secrets.token_hex(16)}.jsonl.gz'
+            s3.put_object(
+                Bucket=ARCHIVE_BUCKET,
+                Key=object_key,
+                Body=gzip.compress('\n'.join(json.dumps(record, ensure_ascii=False) for record in records).encode()),
+                ContentType='application/x-ndjson'
+            )
+            archives.append((chat_id, month_start, object_key, records[0]['id'], records[-1]['id'], len(records)))
+
+    return archives
+
+def archive_partition(conn, s3, partition: str) -> int:
+    '''Выгружает секцию и отсоединяет её от messages в одной транзакции с записью в message_archives'''
+    archives = export_partition(conn, s3, partition)
+
+    cur = conn.cursor()
+    execute_values(cur, """
+        INSERT INTO message_archives (chat_id, month, object_key, min_id, max_id, message_count)
+        VALUES %s
+        ON CONFLICT (chat_id, month) DO UPDATE
+        SET object_key = EXCLUDED.object_key, min_id = EXCLUDED.min_id, max_id = EXCLUDED.max_id,
+            message_count = EXCLUDED.message_count, archived_at = CURRENT_TIMESTAMP
+    """, archives)
+    cur.execute(sql.SQL("ALTER TABLE messages DETACH PARTITION {}").format(sql.Identifier(partition)))
+    cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+    conn.commit()
+    cur.close()
+    return sum(archive[5] for archive in archives)
+
+def handler(event: dict, context) -> dict:
+    '''Обслуживание сообщений по расписанию: создаёт будущие секции, чистит outbox и выгружает холодные секции в объектное хранилище'''
+    headers = event.get('headers', {})
+    job_token = headers.get('X-Job-Token') or headers.get('x-job-token') or ''
+
+    if not job_token or not hmac.compare_digest(job_token.encode(), os.environ.get('ARCHIVE_JOB_TOKEN', '').encode()):
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+
+        cur.execute("SELECT ensure_messages_partitions(%s)", (PARTITIONS_AHEAD,))
+        partitions_created = cur.fetchone()[0]
+        cur.execute(
+            "DELETE FROM message_client_ids WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'",
+            (CLIENT_MSG_ID_RETENTION_DAYS,)
+        )
+        cur.execute(
+            "DELETE FROM outbox WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'",
+            (OUTBOX_RETENTION_HOURS,)
+        )
+        # Истёкшие и отозванные сессии больше не пройдут проверку, держим их неделю только для разбора инцидентов
+        cur.execute(
+            "DELETE FROM sessions WHERE expires_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day' OR revoked_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'",
+            (SESSION_RETENTION_DAYS, SESSION_RETENTION_DAYS)
+        )
+        conn.commit()
+
+        cold_partitions = find_cold_partitions(cur)[:PARTITIONS_PER_RUN]
+        cur.close()
+
+        archived = {}
+        if cold_partitions:
+            s3 = get_s3_client()
+            for partition in cold_partitions:
+                archived[partition] = archive_partition(conn, s3, partition)
+
+        conn.close()
+
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({
+                'success': True,
+                'partitions_created': partitions_created,
+                'archived': archived
+            }),
+            'isBase64Encoded': False
+        }
+
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
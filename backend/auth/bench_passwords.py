@@ -0,0 +1,44 @@
+'''Бенчмарк хэширования паролей: логины в секунду на ядро при разной стоимости scrypt.
+
+База не нужна: меряется только scrypt_digest через run_password_task, как в action=login.
+
+    python bench_passwords.py [--logins 64] [--n 8192 16384 32768 65536]
+'''
+import argparse
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from index import PASSWORD_HASH_WORKERS, SCRYPT_P, SCRYPT_R, run_password_task, scrypt_digest
+
+def bench_cost(n: int, logins: int) -> tuple:
+    salt = secrets.token_bytes(16)
+
+    started = time.perf_counter()
+    scrypt_digest('correct horse battery staple', salt, n, SCRYPT_R, SCRYPT_P)
+    single = time.perf_counter() - started
+
+    # Запросы приходят параллельно, как на тёплом инстансе; пул ограничивает их PASSWORD_HASH_WORKERS потоками
+    with ThreadPoolExecutor(max_workers=logins) as clients:
+        started = time.perf_counter()
+        list(clients.map(lambda _: run_password_task(scrypt_digest, 'correct horse battery staple', salt, n, SCRYPT_R, SCRYPT_P), range(logins)))
+        elapsed = time.perf_counter() - started
+
+    return single, logins / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--n', type=int, nargs='+', default=[2 ** 13, 2 ** 14, 2 ** 15, 2 ** 16])
+    args = parser.parse_args()
+
+    cores = min(PASSWORD_HASH_WORKERS, os.cpu_count() or 1)
+    print(f'workers={PASSWORD_HASH_WORKERS} cores={os.cpu_count()} r={SCRYPT_R} p={SCRYPT_P}')
+    print(f'{"N":>8} {"memory":>8} {"hash ms":>8} {"logins/s":>9} {"per core":>9}')
+    for n in args.n:
+        single, throughput = bench_cost(n, args.logins)
+        print(f'{n:>8} {128 * n * SCRYPT_R // 2 ** 20:>6}MB {single * 1000:>8.1f} {throughput:>9.1f} {throughput / cores:>9.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,162 @@
 import json
 import os
 import hashlib
+import hmac
+import base64
 import secrets
+import time
+import threading
 import psycopg2
+import psycopg2.extensions
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_CHECK_INTERVAL = 30
+SESSION_TTL = 30 * 24 * 3600
+ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', '900'))
+ACCESS_TOKEN_PREFIX = 'at1'
+SCRYPT_N = int(os.environ.get('SCRYPT_N', str(2 ** 14)))
+SCRYPT_R = int(os.environ.get('SCRYPT_R', '8'))
+SCRYPT_P = int(os.environ.get('SCRYPT_P', '1'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 2)))
+PASSWORD_HASH_MAX_PENDING = PASSWORD_HASH_WORKERS * 4
+PASSWORD_HASH_QUEUE_TIMEOUT = 5
+
+_db_pool = []
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+password_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение, которое при close() возвращается в пул для следующих вызовов'''
+
+    def close(self):
+        if self.closed or len(_db_pool) >= DB_POOL_SIZE:
+            return super().close()
+        try:
+            self.rollback()
+        except psycopg2.Error:
+            return super().close()
+        self.released_at = time.monotonic()
+        _db_pool.append(self)
+
+    def discard(self):
+        super().close()
+
+def is_connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < DB_POOL_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    while _db_pool:
+        conn = _db_pool.pop()
+        if is_connection_alive(conn):
+            return conn
+        conn.discard()
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PooledConnection)
+
+def scrypt_digest(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
 
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    '''Соль и параметры хранятся вместе с хэшем: scrypt$n$r$p$salt$hash'''
+    salt = secrets.token_bytes(16)
+    digest = scrypt_digest(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return '$'.join([
+        'scrypt', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+        base64.b64encode(salt).decode(), base64.b64encode(digest).decode()
+    ])
+
+def verify_password(password: str, stored_hash: str):
+    '''Возвращает (пароль верен, нужно ли перехэшировать с текущими параметрами).
+
+    Старые хэши без соли (один SHA-256) тоже принимаются, чтобы перевести их на scrypt при входе.
+    '''
+    if not stored_hash.startswith('scrypt$'):
+        legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy_hash, stored_hash), True
+    
+    _, n, r, p, salt, digest = stored_hash.split('$')
+    n, r, p = int(n), int(r), int(p)
+    expected = scrypt_digest(password, base64.b64decode(salt), n, r, p)
+    is_valid = hmac.compare_digest(expected, base64.b64decode(digest))
+    return is_valid, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+DUMMY_PASSWORD_HASH = hash_password(secrets.token_urlsafe(16))
+
+def run_password_task(fn, *args):
+    '''Выполняет хэширование в ограниченном пуле; None, если очередь переполнена.
+
+    scrypt отпускает GIL, поэтому воркеры считают параллельно, а семафор не даёт
+    всплеску логинов занять все потоки и память процесса.
+    '''
+    if not password_slots.acquire(timeout=PASSWORD_HASH_QUEUE_TIMEOUT):
+        return None
+    try:
+        return password_executor.submit(fn, *args).result()
+    finally:
+        password_slots.release()
 
 def generate_token() -> str:
     return secrets.token_urlsafe(32)
 
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_session(cur, user_id: int) -> str:
+    token = generate_token()
+    cur.execute(
+        "INSERT INTO sessions (user_id, token_hash, expires_at) VALUES (%s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')",
+        (user_id, hash_token(token), SESSION_TTL)
+    )
+    return token
+
+def load_access_token_keys() -> list:
+    '''Ключи подписи из ACCESS_TOKEN_KEYS="kid:secret,kid2:secret2"; первый ключ текущий.
+
+    Для ротации новый ключ ставится первым во всех функциях, а старый удаляется
+    не раньше чем через ACCESS_TOKEN_TTL, когда истекут подписанные им токены.
+    '''
+    keys = []
+    for entry in os.environ.get('ACCESS_TOKEN_KEYS', '').split(','):
+        key_id, _, secret = entry.strip().partition(':')
+        if key_id and secret:
+            keys.append((key_id, secret.encode()))
+    return keys
+
+ACCESS_TOKEN_KEYS = load_access_token_keys()
+
+def b64encode_url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def issue_access_token(user_id: int):
+    '''Короткоживущий токен вида at1.<kid>.<payload>.<hmac>, проверяемый без базы'''
+    if not ACCESS_TOKEN_KEYS:
+        return None
+    key_id, key = ACCESS_TOKEN_KEYS[0]
+    payload = b64encode_url(json.dumps({'uid': user_id, 'exp': int(time.time()) + ACCESS_TOKEN_TTL}).encode())
+    signing_input = f'{ACCESS_TOKEN_PREFIX}.{key_id}.{payload}'
+    signature = b64encode_url(hmac.new(key, signing_input.encode(), hashlib.sha256).digest())
+    return f'{signing_input}.{signature}'
+
+def token_response(user_id: int, refresh_token: str) -> dict:
+    '''Поля ответа с токенами; без ключей подписи клиент работает напрямую с токеном сессии'''
+    access_token = issue_access_token(user_id)
+    return {
+        'token': access_token or refresh_token,
+        'refresh_token': refresh_token,
+        'expires_in': ACCESS_TOKEN_TTL if access_token else SESSION_TTL
+    }
+
 def handler(event: dict, context) -> dict:
     '''API для регистрации и авторизации пользователей'''
     method = event.get('httpMethod', 'GET')
@@ -68,7 +211,17 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            password_hash = hash_password(password)
+            password_hash = run_password_task(hash_password, password)
+            
+            if not password_hash:
+                cur.close()
+                conn.close()
+                return {
+                    'statusCode': 503,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Retry-After': '1'},
+                    'body': json.dumps({'error': 'Сервер перегружен, попробуйте ещё раз'}),
+                    'isBase64Encoded': False
+                }
             
             try:
                 cur.execute(
@@ -78,11 +231,11 @@ def handler(event: dict, context) -> dict:
                 user = cur.fetchone()
                 conn.commit()
                 
-                token = generate_token()
                 user_id = user[0]
+                token = create_session(cur, user_id)
                 
                 cur.execute(
-                    "UPDATE users SET is_online = true WHERE id = %s",
+                    "UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = %s",
                     (user_id,)
                 )
                 conn.commit()
@@ -95,7 +248,7 @@ def handler(event: dict, context) -> dict:
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'body': json.dumps({
                         'success': True,
-                        'token': token,
+                        **token_response(user_id, token),
                         'user': {
                             'id': user[0],
                             'username': user[1],
@@ -128,15 +281,27 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            password_hash = hash_password(password)
-            
             cur.execute(
-                "SELECT id, username, nickname, email, avatar_url, status_text, status_emoji FROM users WHERE username = %s AND password_hash = %s",
-                (username, password_hash)
+                "SELECT id, username, nickname, email, avatar_url, status_text, status_emoji, password_hash FROM users WHERE username = %s",
+                (username,)
             )
             user = cur.fetchone()
             
-            if not user:
+            verification = run_password_task(verify_password, password, user[7] if user else DUMMY_PASSWORD_HASH)
+            
+            if not verification:
+                cur.close()
+                conn.close()
+                return {
+                    'statusCode': 503,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Retry-After': '1'},
+                    'body': json.dumps({'error': 'Сервер перегружен, попробуйте ещё раз'}),
+                    'isBase64Encoded': False
+                }
+            
+            is_valid, needs_rehash = verification
+            
+            if not user or not is_valid:
                 cur.close()
                 conn.close()
                 return {
@@ -146,11 +311,19 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            token = generate_token()
             user_id = user[0]
+            token = create_session(cur, user_id)
+            
+            if needs_rehash:
+                new_hash = run_password_task(hash_password, password)
+                if new_hash:
+                    cur.execute(
+                        "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                        (new_hash, user_id, user[7])
+                    )
             
             cur.execute(
-                "UPDATE users SET is_online = true, last_seen = CURRENT_TIMESTAMP WHERE id = %s",
+                "UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = %s",
                 (user_id,)
             )
             conn.commit()
@@ -162,7 +335,7 @@ def handler(event: dict, context) -> dict:
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
                     'success': True,
-                    'token': token,
+                    **token_response(user_id, token),
                     'user': {
                         'id': user[0],
                         'username': user[1],
@@ -176,6 +349,53 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
+        elif action == 'refresh':
+            refresh_token = body.get('refresh_token', '')
+            
+            cur.execute(
+                "SELECT user_id FROM sessions WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP",
+                (hash_token(refresh_token),)
+            )
+            session = cur.fetchone()
+            cur.close()
+            conn.close()
+            
+            if not session:
+                return {
+                    'statusCode': 401,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Сессия истекла'}),
+                    'isBase64Encoded': False
+                }
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, **token_response(session[0], refresh_token)}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'logout':
+            headers = event.get('headers', {})
+            token = body.get('refresh_token') or headers.get('X-Auth-Token') or headers.get('x-auth-token')
+            
+            if token:
+                cur.execute(
+                    "UPDATE sessions SET revoked_at = CURRENT_TIMESTAMP WHERE token_hash = %s AND revoked_at IS NULL",
+                    (hash_token(token),)
+                )
+                conn.commit()
+            
+            cur.close()
+            conn.close()
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True}),
+                'isBase64Encoded': False
+            }
+        
         else:
             cur.close()
             conn.close()
@@ -0,0 +1,51 @@
+'''Бенчмарк холодного и тёплого старта клиента S3 в функции files.
+
+Сеть не нужна: меряются импорт модуля, OPTIONS preflight, первый вызов get_s3_client()
+(импорт boto3 и сборка клиента) и повторные вызовы, а также прежний вариант, где клиент
+собирался на каждый запрос. Время самих запросов к хранилищу сюда не входит.
+
+    python bench_s3_client.py [--requests 50]
+'''
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    import index
+    print(f'import index:              {(time.perf_counter() - started) * 1000:8.1f} ms')
+
+    _, options_ms = timed(index.handler, {'httpMethod': 'OPTIONS'}, None)
+    print(f'OPTIONS preflight:         {options_ms:8.2f} ms (boto3 imported: {"boto3" in sys.modules})')
+
+    _, cold_ms = timed(index.get_s3_client)
+    print(f'cold get_s3_client():      {cold_ms:8.1f} ms')
+
+    warm_ms = sum(timed(index.get_s3_client)[1] for _ in range(args.requests)) / args.requests
+    print(f'warm get_s3_client():      {warm_ms:8.4f} ms/request')
+
+    import boto3
+    per_request_ms = sum(timed(
+        lambda: boto3.client('s3',
+            endpoint_url=index.S3_ENDPOINT_URL,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    )[1] for _ in range(args.requests)) / args.requests
+    print(f'new client per request:    {per_request_ms:8.1f} ms/request (previous behaviour)')
+
+if __name__ == '__main__':
+    main()
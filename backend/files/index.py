@@ -1,19 +1,291 @@
 import json
 import os
-import boto3
+import time
 import base64
+import hashlib
+import hmac
+import io
+import logging
 import uuid
+import psycopg2
+import psycopg2.extensions
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_CHECK_INTERVAL = 30
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_SIZE = 10000
+ACCESS_TOKEN_PREFIX = 'at1'
+S3_BUCKET = 'files'
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+PRESIGNED_URL_TTL = 3600
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MAX_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+THUMBNAIL_SIZES = (160, 320, 640)
+PLACEHOLDER_SIZE = 16
+PREVIEW_MAX_SOURCE_SIZE = 25 * 1024 * 1024
+PREVIEW_MAX_PIXELS = 50_000_000
+DEDUP_MAX_SIZE = 64 * 1024 * 1024
+PREVIEW_WORKERS = 3
+S3_MAX_POOL_CONNECTIONS = 16
+
+_db_pool = []
+_session_cache = OrderedDict()
+_s3_client = None
+logger = logging.getLogger(__name__)
+preview_executor = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS)
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение, которое при close() возвращается в пул для следующих вызовов'''
+
+    def close(self):
+        if self.closed or len(_db_pool) >= DB_POOL_SIZE:
+            return super().close()
+        try:
+            self.rollback()
+        except psycopg2.Error:
+            return super().close()
+        self.released_at = time.monotonic()
+        _db_pool.append(self)
+
+    def discard(self):
+        super().close()
+
+def is_connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < DB_POOL_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    while _db_pool:
+        conn = _db_pool.pop()
+        if is_connection_alive(conn):
+            return conn
+        conn.discard()
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PooledConnection)
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def load_access_token_keys() -> dict:
+    '''Ключи подписи access-токенов из ACCESS_TOKEN_KEYS="kid:secret,kid2:secret2"'''
+    keys = {}
+    for entry in os.environ.get('ACCESS_TOKEN_KEYS', '').split(','):
+        key_id, _, secret = entry.strip().partition(':')
+        if key_id and secret:
+            keys[key_id] = secret.encode()
+    return keys
+
+ACCESS_TOKEN_KEYS = load_access_token_keys()
+
+def verify_access_token(token: str):
+    '''Проверяет подписанный access-токен без обращения к базе; возвращает id пользователя или None'''
+    try:
+        prefix, key_id, payload, signature = token.split('.')
+    except ValueError:
+        return None
+    key = ACCESS_TOKEN_KEYS.get(key_id)
+    if prefix != ACCESS_TOKEN_PREFIX or not key:
+        return None
+    
+    expected = hmac.new(key, f'{prefix}.{key_id}.{payload}'.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(base64.urlsafe_b64encode(expected).rstrip(b'='), signature.encode()):
+        return None
+    
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    if claims['exp'] <= time.time():
+        return None
+    return claims['uid']
+
+def authenticate(headers: dict):
+    '''Возвращает id пользователя по токену из X-Auth-Token.
+
+    Подписанные access-токены проверяются локально по HMAC. Если ACCESS_TOKEN_KEYS задан,
+    токены сессий (refresh) здесь не принимаются: их обменивает на access-токен только
+    auth?action=refresh. Без ключей токены сессий проверяются по базе.
+
+    Проверенные токены кэшируются в процессе (LRU + TTL), поэтому горячие пути опроса
+    не ходят в базу на каждый запрос; отзыв сессии виден не позже чем через SESSION_CACHE_TTL.
+    '''
+    token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+    if not token:
+        return None
+    if token.startswith(ACCESS_TOKEN_PREFIX + '.'):
+        return verify_access_token(token)
+    if ACCESS_TOKEN_KEYS:
+        return None
+    
+    token_hash = hash_token(token)
+    now = time.monotonic()
+    cached = _session_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _session_cache.move_to_end(token_hash)
+        return cached[0]
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT user_id, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+        FROM sessions
+        WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """, (token_hash,))
+    session = cur.fetchone()
+    cur.close()
+    conn.close()
+    
+    if not session:
+        _session_cache.pop(token_hash, None)
+        return None
+    
+    _session_cache[token_hash] = (session[0], now + min(SESSION_CACHE_TTL, float(session[1])))
+    _session_cache.move_to_end(token_hash)
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+    return session[0]
+
 def get_s3_client():
-    return boto3.client('s3',
-        endpoint_url='https://bucket.poehali.dev',
-        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+    '''Клиент S3 создаётся один раз на инстанс; boto3 импортируется лениво, чтобы OPTIONS не платил за импорт'''
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        from botocore.config import Config
+        _s3_client = boto3.client('s3',
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS, tcp_keepalive=True)
+        )
+    return _s3_client
+
+def build_object_key(user_id, file_name: str) -> str:
+    file_ext = file_name.split('.')[-1] if '.' in file_name else 'bin'
+    return f"{user_id}/{datetime.now().strftime('%Y%m%d')}/{uuid.uuid4().hex}.{file_ext}"
+
+def build_content_key(sha256: str, file_name: str) -> str:
+    file_ext = file_name.split('.')[-1] if '.' in file_name else 'bin'
+    return f"content/{sha256[:2]}/{sha256}.{file_ext}"
+
+def build_cdn_url(object_key: str) -> str:
+    return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{object_key}"
+
+def find_file_by_hash(sha256: str):
+    '''Ищет уже загруженный файл с тем же содержимым и увеличивает счётчик ссылок; третий элемент — нет ли у него превью'''
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE files SET ref_count = ref_count + 1
+        WHERE sha256 = %s
+        RETURNING id, object_key, thumbnails IS NULL
+    """, (sha256,))
+    existing = cur.fetchone()
+    conn.commit()
+    cur.close()
+    conn.close()
+    return existing
+
+def register_file(user_id, object_key: str, file_name: str, file_type: str, file_size: int, sha256: str) -> tuple:
+    '''Сохраняет метаданные файла; возвращает id, ключ объекта с этим содержимым, признак новой записи и отсутствия превью'''
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO files (object_key, user_id, file_name, file_type, file_size, sha256)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (sha256) DO UPDATE SET ref_count = files.ref_count + 1
+        RETURNING id, object_key, xmax = 0, thumbnails IS NULL
+    """, (object_key, int(user_id), file_name, file_type, file_size, sha256))
+    registered = cur.fetchone()
+    conn.commit()
+    cur.close()
+    conn.close()
+    return registered
+
+def read_object(s3, object_key: str, keep_data: bool) -> tuple:
+    '''Считает SHA-256 объекта потоком; содержимое сохраняется только если оно нужно для превью'''
+    digest = hashlib.sha256()
+    chunks = []
+    stream = s3.get_object(Bucket=S3_BUCKET, Key=object_key)['Body']
+    for chunk in stream.iter_chunks(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+        if keep_data:
+            chunks.append(chunk)
+    return digest.hexdigest(), b''.join(chunks) if keep_data else None
+
+def is_previewable(file_type: str, file_size: int) -> bool:
+    return file_type.startswith('image/') and file_size <= PREVIEW_MAX_SOURCE_SIZE
+
+def generate_previews(s3, image_data: bytes, sha256: str) -> tuple:
+    '''Строит миниатюры нескольких размеров в пуле потоков и крошечный LQIP-плейсхолдер'''
+    from PIL import Image, ImageOps
+    
+    source = Image.open(io.BytesIO(image_data))
+    if source.width * source.height > PREVIEW_MAX_PIXELS:
+        raise Image.DecompressionBombError(f'image too large for preview: {source.width}x{source.height}')
+    source = ImageOps.exif_transpose(source).convert('RGB')
+    
+    def render_thumbnail(size: int) -> tuple:
+        image = source.copy()
+        image.thumbnail((size, size))
+        buffer = io.BytesIO()
+        image.save(buffer, 'WEBP', quality=80)
+        thumbnail_key = f"thumbs/{sha256[:2]}/{sha256}_{size}.webp"
+        s3.put_object(Bucket=S3_BUCKET, Key=thumbnail_key, Body=buffer.getvalue(), ContentType='image/webp')
+        return str(size), build_cdn_url(thumbnail_key)
+    
+    thumbnails = dict(preview_executor.map(render_thumbnail, THUMBNAIL_SIZES))
+    
+    tiny = source.copy()
+    tiny.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    buffer = io.BytesIO()
+    tiny.save(buffer, 'JPEG', quality=40)
+    placeholder = 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+    
+    return thumbnails, placeholder
+
+def save_previews(s3, file_id: int, image_data: bytes, sha256: str):
+    '''Битая или слишком большая картинка остаётся без превью; ошибки S3 и базы пробрасываются'''
+    from PIL import Image, UnidentifiedImageError
+    
+    try:
+        thumbnails, placeholder = generate_previews(s3, image_data, sha256)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        logger.warning('files: no previews for file %s: %s', file_id, e)
+        return None
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE files SET thumbnails = %s, placeholder = %s WHERE id = %s",
+        (json.dumps(thumbnails), placeholder, file_id)
     )
+    conn.commit()
+    cur.close()
+    conn.close()
+    return {'thumbnails': thumbnails, 'placeholder': placeholder}
+
+def list_uploaded_parts(s3, object_key: str, upload_id: str) -> list:
+    parts = []
+    marker = 0
+    while True:
+        page = s3.list_parts(Bucket=S3_BUCKET, Key=object_key, UploadId=upload_id, PartNumberMarker=marker)
+        parts.extend({'part_number': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']} for part in page.get('Parts', []))
+        if not page.get('IsTruncated'):
+            return parts
+        marker = page['NextPartNumberMarker']
 
 def handler(event: dict, context) -> dict:
-    '''API для загрузки файлов и изображений в S3'''
+    '''API для загрузки файлов и изображений в S3: напрямую по presigned URL или через base64'''
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -22,7 +294,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -38,8 +310,7 @@ def handler(event: dict, context) -> dict:
         }
     
     try:
-        headers = event.get('headers', {})
-        user_id = headers.get('X-User-Id') or headers.get('x-user-id')
+        user_id = authenticate(event.get('headers', {}))
         
         if not user_id:
             return {
@@ -50,10 +321,232 @@ def handler(event: dict, context) -> dict:
             }
         
         body = json.loads(event.get('body', '{}'))
-        file_data_base64 = body.get('file_data')
+        action = body.get('action')
         file_name = body.get('file_name', 'file')
         file_type = body.get('file_type', 'application/octet-stream')
         
+        if action == 'create_upload':
+            file_size = body.get('file_size')
+            
+            if type(file_size) is not int or not 0 < file_size <= MAX_UPLOAD_SIZE:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': f'file_size must be an integer from 1 to {MAX_UPLOAD_SIZE}'}),
+                    'isBase64Encoded': False
+                }
+            
+            sha256 = (body.get('sha256') or '').lower()
+            existing = find_file_by_hash(sha256) if sha256 else None
+            if existing:
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'success': True,
+                        'deduplicated': True,
+                        'file_id': existing[0],
+                        'file_url': build_cdn_url(existing[1]),
+                        'file_name': file_name
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            object_key = build_object_key(user_id, file_name)
+            s3 = get_s3_client()
+            
+            if file_size <= MULTIPART_THRESHOLD:
+                upload_url = s3.generate_presigned_url(
+                    'put_object',
+                    Params={'Bucket': S3_BUCKET, 'Key': object_key, 'ContentType': file_type},
+                    ExpiresIn=PRESIGNED_URL_TTL
+                )
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'success': True,
+                        'object_key': object_key,
+                        'upload_url': upload_url
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            upload = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=object_key, ContentType=file_type)
+            part_count = -(-file_size // MULTIPART_PART_SIZE)
+            part_urls = [
+                s3.generate_presigned_url(
+                    'upload_part',
+                    Params={'Bucket': S3_BUCKET, 'Key': object_key, 'UploadId': upload['UploadId'], 'PartNumber': part_number},
+                    ExpiresIn=PRESIGNED_URL_TTL
+                )
+                for part_number in range(1, part_count + 1)
+            ]
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'object_key': object_key,
+                    'upload_id': upload['UploadId'],
+                    'part_size': MULTIPART_PART_SIZE,
+                    'part_urls': part_urls
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if action == 'start_chunked_upload':
+            object_key = build_object_key(user_id, file_name)
+            upload = get_s3_client().create_multipart_upload(Bucket=S3_BUCKET, Key=object_key, ContentType=file_type)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'object_key': object_key,
+                    'upload_id': upload['UploadId'],
+                    'chunk_size': MULTIPART_PART_SIZE
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if action in ('upload_chunk', 'upload_status', 'abort_upload'):
+            object_key = body.get('object_key', '')
+            upload_id = body.get('upload_id')
+            
+            if not upload_id or not object_key.startswith(f'{user_id}/'):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'upload_id and object_key required'}),
+                    'isBase64Encoded': False
+                }
+            
+            s3 = get_s3_client()
+            
+            if action == 'abort_upload':
+                s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=object_key, UploadId=upload_id)
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': True}),
+                    'isBase64Encoded': False
+                }
+            
+            if action == 'upload_status':
+                parts = list_uploaded_parts(s3, object_key, upload_id)
+                next_part_number = 1
+                for part in parts:
+                    if part['part_number'] != next_part_number:
+                        break
+                    next_part_number += 1
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'success': True,
+                        'parts': parts,
+                        'next_part_number': next_part_number,
+                        'next_offset': (next_part_number - 1) * MULTIPART_PART_SIZE
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            part_number = int(body.get('part_number', 0))
+            offset = int(body.get('offset', -1))
+            chunk_data = base64.b64decode(body.get('chunk_data', ''))
+            
+            if part_number < 1 or offset != (part_number - 1) * MULTIPART_PART_SIZE or not chunk_data or len(chunk_data) > MULTIPART_PART_SIZE:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': f'Invalid chunk: expected offset {(max(part_number, 1) - 1) * MULTIPART_PART_SIZE} and at most {MULTIPART_PART_SIZE} bytes'}),
+                    'isBase64Encoded': False
+                }
+            
+            part = s3.upload_part(Bucket=S3_BUCKET, Key=object_key, UploadId=upload_id, PartNumber=part_number, Body=chunk_data)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'part_number': part_number,
+                    'etag': part['ETag'],
+                    'next_offset': offset + len(chunk_data)
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if action == 'complete_upload':
+            object_key = body.get('object_key', '')
+            upload_id = body.get('upload_id')
+            parts = body.get('parts') or []
+            
+            if not object_key.startswith(f'{user_id}/'):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'object_key required'}),
+                    'isBase64Encoded': False
+                }
+            
+            s3 = get_s3_client()
+            
+            if upload_id:
+                if not parts:
+                    parts = list_uploaded_parts(s3, object_key, upload_id)
+                s3.complete_multipart_upload(
+                    Bucket=S3_BUCKET,
+                    Key=object_key,
+                    UploadId=upload_id,
+                    MultipartUpload={'Parts': [
+                        {'ETag': part['etag'], 'PartNumber': int(part['part_number'])}
+                        for part in sorted(parts, key=lambda part: int(part['part_number']))
+                    ]}
+                )
+            
+            head = s3.head_object(Bucket=S3_BUCKET, Key=object_key)
+            content_type = head.get('ContentType', file_type)
+            previewable = is_previewable(content_type, head['ContentLength'])
+            
+            # Большие файлы не читаем обратно ради хэша: они не дедуплицируются и получают случайный ключ
+            if head['ContentLength'] <= DEDUP_MAX_SIZE:
+                sha256, file_data = read_object(s3, object_key, previewable)
+            else:
+                sha256, file_data = None, None
+            
+            # Presigned URL на object_key действует ещё PRESIGNED_URL_TTL, поэтому регистрируем
+            # неизменяемую копию по ключу содержимого, а загруженный объект удаляем
+            content_key = build_content_key(sha256 or uuid.uuid4().hex, file_name)
+            s3.copy_object(Bucket=S3_BUCKET, Key=content_key, CopySource={'Bucket': S3_BUCKET, 'Key': object_key}, ContentType=content_type, MetadataDirective='REPLACE')
+            s3.delete_object(Bucket=S3_BUCKET, Key=object_key)
+            file_id, canonical_key, inserted, missing_preview = register_file(user_id, content_key, file_name, content_type, head['ContentLength'], sha256)
+            if canonical_key != content_key:
+                s3.delete_object(Bucket=S3_BUCKET, Key=content_key)
+            
+            preview = save_previews(s3, file_id, file_data, sha256) if missing_preview and previewable else None
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'deduplicated': not inserted,
+                    'file_id': file_id,
+                    'file_url': build_cdn_url(canonical_key),
+                    'file_name': file_name,
+                    'preview': preview
+                }),
+                'isBase64Encoded': False
+            }
+        
+        file_data_base64 = body.get('file_data')
+        
         if not file_data_base64:
             return {
                 'statusCode': 400,
@@ -63,27 +556,38 @@ def handler(event: dict, context) -> dict:
             }
         
         file_data = base64.b64decode(file_data_base64)
+        sha256 = hashlib.sha256(file_data).hexdigest()
         
-        file_ext = file_name.split('.')[-1] if '.' in file_name else 'bin'
-        unique_name = f"{user_id}/{datetime.now().strftime('%Y%m%d')}/{uuid.uuid4().hex}.{file_ext}"
-        
-        s3 = get_s3_client()
-        s3.put_object(
-            Bucket='files',
-            Key=unique_name,
-            Body=file_data,
-            ContentType=file_type
-        )
-        
-        cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{unique_name}"
+        existing = find_file_by_hash(sha256)
+        deduplicated = existing is not None
+        preview = None
+        if deduplicated:
+            file_id, canonical_key, missing_preview = existing
+            if missing_preview and is_previewable(file_type, len(file_data)):
+                preview = save_previews(get_s3_client(), file_id, file_data, sha256)
+        else:
+            content_key = build_content_key(sha256, file_name)
+            s3 = get_s3_client()
+            s3.put_object(
+                Bucket=S3_BUCKET,
+                Key=content_key,
+                Body=file_data,
+                ContentType=file_type
+            )
+            file_id, canonical_key, inserted, missing_preview = register_file(user_id, content_key, file_name, file_type, len(file_data), sha256)
+            if missing_preview and is_previewable(file_type, len(file_data)):
+                preview = save_previews(s3, file_id, file_data, sha256)
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'success': True,
-                'file_url': cdn_url,
-                'file_name': file_name
+                'deduplicated': deduplicated,
+                'file_id': file_id,
+                'file_url': build_cdn_url(canonical_key),
+                'file_name': file_name,
+                'preview': preview
             }),
             'isBase64Encoded': False
         }
@@ -0,0 +1,68 @@
+'''Бенчмарк проверки токена на запрос: HMAC access-токена против поиска сессии в базе.
+
+HMAC-часть не требует базы. Если задан DATABASE_URL, дополнительно меряется тот же
+индексированный SELECT по sessions, что authenticate() делает для токена сессии без кэша.
+
+    python bench_auth.py [--iterations 100000] [--lookups 1000]
+'''
+import argparse
+import importlib.util
+import os
+import secrets
+import time
+
+os.environ.setdefault('ACCESS_TOKEN_KEYS', f'bench:{secrets.token_hex(32)}')
+
+from index import get_db_connection, hash_token, verify_access_token
+
+def load_auth_module():
+    '''Токен выпускаем кодом auth, чтобы мерить проверку ровно того формата, что уходит клиентам'''
+    spec = importlib.util.spec_from_file_location('auth_index', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'auth', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bench_verify(token: str, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        verify_access_token(token)
+    return (time.perf_counter() - started) / iterations
+
+def bench_session_lookup(lookups: int) -> float:
+    token_hash = hash_token(secrets.token_urlsafe(32))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    started = time.perf_counter()
+    for _ in range(lookups):
+        cur.execute("""
+            SELECT user_id, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+            FROM sessions
+            WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+        """, (token_hash,))
+        cur.fetchone()
+    elapsed = time.perf_counter() - started
+    cur.close()
+    conn.close()
+    return elapsed / lookups
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=1000)
+    args = parser.parse_args()
+
+    token = load_auth_module().issue_access_token(42)
+    assert verify_access_token(token) == 42
+
+    verify_cost = bench_verify(token, args.iterations)
+    print(f'access token verify: {verify_cost * 1e6:.2f} us/request ({1 / verify_cost:,.0f} verifies/s per core)')
+
+    if os.environ.get('DATABASE_URL'):
+        lookup_cost = bench_session_lookup(args.lookups)
+        print(f'session lookup:      {lookup_cost * 1e6:.2f} us/request over a pooled connection')
+        print(f'speedup:             {lookup_cost / verify_cost:.0f}x')
+    else:
+        print('session lookup:      skipped, set DATABASE_URL to compare against the database')
+
+if __name__ == '__main__':
+    main()
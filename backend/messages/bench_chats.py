@@ -0,0 +1,97 @@
+'''Регрессионный бенчмарк action=chats: число SQL-запросов не должно расти с числом чатов.
+
+Запускать только на отдельной базе с применёнными миграциями. Для каждого размера
+(по умолчанию 10, 100 и 1000) создаётся пользователь с таким числом личных чатов,
+запрос action=chats проходит через handler(), а все cursor.execute() считаются.
+Скрипт завершается с кодом 1, если число запросов отличается между размерами.
+
+    DATABASE_URL=postgres://... python bench_chats.py [--sizes 10 100 1000]
+'''
+import argparse
+import hashlib
+import json
+import os
+import secrets
+import sys
+import time
+
+import psycopg2.extensions
+
+os.environ.pop('ACCESS_TOKEN_KEYS', None)
+os.environ.pop('CACHE_REDIS_URL', None)
+
+import index
+
+statements = []
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        statements.append(query)
+        return super().execute(query, vars)
+
+pooled_connection = index.get_db_connection
+
+def counting_connection():
+    conn = pooled_connection()
+    conn.cursor_factory = CountingCursor
+    return conn
+
+def create_user_with_chats(chat_count: int) -> str:
+    '''Пользователь с chat_count личными чатами; возвращает токен сессии'''
+    run_id = secrets.token_hex(4)
+    token = secrets.token_urlsafe(32)
+    conn = pooled_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO users (username, nickname, email, password_hash)
+        SELECT 'chats_' || %(run)s || '_' || i, 'Chats ' || i, 'chats_' || %(run)s || '_' || i || '@bench.invalid', 'bench'
+        FROM generate_series(0, %(count)s) AS i
+        RETURNING id
+    """, {'run': run_id, 'count': chat_count})
+    owner_id, *counterpart_ids = sorted(row[0] for row in cur.fetchall())
+    cur.execute("""
+        INSERT INTO chats (is_group, created_by)
+        SELECT false, %s FROM generate_series(1, %s)
+        RETURNING id
+    """, (owner_id, chat_count))
+    chat_ids = [row[0] for row in cur.fetchall()]
+    cur.execute("""
+        INSERT INTO chat_members (chat_id, user_id)
+        SELECT chat_id, member_id
+        FROM unnest(%s::int[], %s::int[]) AS pairs(chat_id, counterpart_id),
+            LATERAL unnest(ARRAY[%s, counterpart_id]) AS member_id
+    """, (chat_ids, counterpart_ids, owner_id))
+    cur.execute(
+        "INSERT INTO sessions (user_id, token_hash, expires_at) VALUES (%s, %s, CURRENT_TIMESTAMP + INTERVAL '1 hour')",
+        (owner_id, hashlib.sha256(token.encode()).hexdigest())
+    )
+    conn.commit()
+    cur.close()
+    conn.close()
+    return token
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit('DATABASE_URL is required')
+
+    index.get_db_connection = counting_connection
+    counts = {}
+    for size in args.sizes:
+        token = create_user_with_chats(size)
+        statements.clear()
+        started = time.perf_counter()
+        response = index.handler({'httpMethod': 'GET', 'queryStringParameters': {'action': 'chats'}, 'headers': {'X-Auth-Token': token}}, None)
+        elapsed = (time.perf_counter() - started) * 1000
+        chats = json.loads(response['body']).get('chats', [])
+        counts[size] = len(statements)
+        print(f'{size:>6} chats: {len(statements)} statements, {len(chats)} returned, {elapsed:.1f} ms')
+
+    if len(set(counts.values())) != 1:
+        sys.exit(f'statement count grows with chat count: {counts}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''Бенчмарк задержки запроса с пулом соединений и без него.
+
+Нужен локальный Postgres в DATABASE_URL. Каждый «запрос» берёт соединение, выполняет
+короткий SELECT и закрывает соединение, как обработчики функций. Без пула это
+psycopg2.connect() на каждый запрос, с пулом — get_db_connection() из index.py.
+
+    DATABASE_URL=postgres://... python bench_pool.py [--requests 500]
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from index import get_db_connection
+
+def run_requests(connect, requests: int) -> list:
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        conn = connect()
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.fetchone()
+        cur.close()
+        conn.close()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f'{name:<10} mean {statistics.mean(latencies):7.2f} ms  p50 {statistics.median(latencies):7.2f} ms  p99 {p99:7.2f} ms')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit('DATABASE_URL is required')
+
+    report('no pool', run_requests(lambda: psycopg2.connect(os.environ['DATABASE_URL']), args.requests))
+    report('pool', run_requests(get_db_connection, args.requests))
+
+if __name__ == '__main__':
+    main()
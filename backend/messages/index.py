@@ -1,10 +1,539 @@
 import json
 import os
+import hashlib
+import gzip
+import hmac
+import base64
+import select
+import time
+import uuid
 import psycopg2
-from datetime import datetime
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+UNREAD_COUNT_CAP = 100
+SEARCH_RESULTS_LIMIT = 50
+SEARCH_INFIX_MIN_LENGTH = 3
+SEND_BATCH_MAX = 50
+ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET', 'moonly-archive')
+ARCHIVE_CACHE_SIZE = 32
+ARCHIVE_MAX_ID = 2 ** 31 - 1
+CURSOR_TIME_MARGIN = timedelta(minutes=1)
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_CHECK_INTERVAL = 30
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_SIZE = 10000
+ACCESS_TOKEN_PREFIX = 'at1'
+PUSH_CHANNEL = 'moonly_events'
+CHAT_CHANNEL = 'moonly_chat_{}'
+LONG_POLL_MAX_WAIT = 25
+PRESENCE_ONLINE_WINDOW = 120
+TYPING_TTL = 6
+TYPING_NOTIFY_INTERVAL = 3
+TYPING_STATE_SIZE = 10000
+PROFILE_CACHE_TTL = 30
+CHAT_MEMBERS_CACHE_TTL = 300
+CACHE_MAX_SIZE = 10000
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+
+_db_pool = []
+_session_cache = OrderedDict()
+_typing_users = {}
+_typing_notified_at = {}
+_s3_client = None
+_archive_cache = OrderedDict()
+_redis_client = None
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение, которое при close() возвращается в пул для следующих вызовов'''
+
+    def close(self):
+        if self.closed or len(_db_pool) >= DB_POOL_SIZE:
+            return super().close()
+        try:
+            self.rollback()
+        except psycopg2.Error:
+            return super().close()
+        self.released_at = time.monotonic()
+        _db_pool.append(self)
+
+    def discard(self):
+        super().close()
+
+def is_connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < DB_POOL_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    while _db_pool:
+        conn = _db_pool.pop()
+        if is_connection_alive(conn):
+            return conn
+        conn.discard()
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PooledConnection)
+
+def get_redis_client():
+    '''Redis-совместимое хранилище для кэша включается через CACHE_REDIS_URL; redis импортируется лениво'''
+    global _redis_client
+    if CACHE_REDIS_URL and _redis_client is None:
+        import redis
+        _redis_client = redis.Redis.from_url(CACHE_REDIS_URL)
+    return _redis_client
+
+class ReadThroughCache:
+    '''LRU + TTL кэш в памяти инстанса; с CACHE_REDIS_URL значения лежат в Redis и общие для всех инстансов'''
+
+    def __init__(self, namespace: str, ttl: int, max_size: int = CACHE_MAX_SIZE):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: list, load) -> dict:
+        '''Возвращает значения по ключам; промахи догружаются одним вызовом load(missing_keys)'''
+        found = self._read(keys)
+        missing = [key for key in keys if key not in found]
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            loaded = load(missing)
+            self._write(loaded)
+            found.update(loaded)
+        return found
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+        redis_client = get_redis_client()
+        if redis_client and keys:
+            redis_client.delete(*[self._redis_key(key) for key in keys])
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'redis' if CACHE_REDIS_URL else 'memory',
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+    def _redis_key(self, key) -> str:
+        return f'moonly:{self.namespace}:{key}'
+
+    def _read(self, keys: list) -> dict:
+        redis_client = get_redis_client()
+        if redis_client:
+            values = redis_client.mget([self._redis_key(key) for key in keys])
+            return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+        
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                found[key] = entry[0]
+        return found
+
+    def _write(self, values: dict):
+        redis_client = get_redis_client()
+        if redis_client:
+            pipeline = redis_client.pipeline()
+            for key, value in values.items():
+                pipeline.set(self._redis_key(key), json.dumps(value), ex=self.ttl)
+            pipeline.execute()
+            return
+        
+        expires_at = time.monotonic() + self.ttl
+        for key, value in values.items():
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+profile_cache = ReadThroughCache('profile', PROFILE_CACHE_TTL)
+chat_members_cache = ReadThroughCache('chat_members', CHAT_MEMBERS_CACHE_TTL)
+
+def load_profile_cards(cur, user_ids: list) -> dict:
+    cur.execute("""
+        SELECT id, username, nickname, email, avatar_url, status_text, status_emoji,
+            last_seen > CURRENT_TIMESTAMP - %s * INTERVAL '1 second', last_seen
+        FROM users
+        WHERE id = ANY(%s)
+    """, (PRESENCE_ONLINE_WINDOW, user_ids))
+    return {
+        row[0]: {
+            'id': row[0],
+            'username': row[1],
+            'nickname': row[2],
+            'email': row[3],
+            'avatar_url': row[4],
+            'status_text': row[5],
+            'status_emoji': row[6],
+            'is_online': row[7],
+            'last_seen': row[8].isoformat() if row[8] else None
+        }
+        for row in cur.fetchall()
+    }
+
+def load_chat_members(cur, chat_ids: list) -> dict:
+    cur.execute("""
+        SELECT chat_id, array_agg(user_id ORDER BY user_id)
+        FROM chat_members
+        WHERE chat_id = ANY(%s)
+        GROUP BY chat_id
+    """, (chat_ids,))
+    return {row[0]: row[1] for row in cur.fetchall()}
+
+def build_etag(*parts) -> str:
+    '''Слабый тег версии ответа: хэш от дешёвых признаков изменения, а не от тела'''
+    return 'W/"' + hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest() + '"'
+
+def is_not_modified(headers: dict, etag: str) -> bool:
+    value = headers.get('If-None-Match') or headers.get('if-none-match') or ''
+    return etag.removeprefix('W/') in (candidate.strip().removeprefix('W/') for candidate in value.split(','))
+
+def etag_headers(etag: str) -> dict:
+    return {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'no-cache',
+        'ETag': etag
+    }
+
+def not_modified_response(etag: str) -> dict:
+    return {
+        'statusCode': 304,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag', 'ETag': etag},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def load_access_token_keys() -> dict:
+    '''Ключи подписи access-токенов из ACCESS_TOKEN_KEYS="kid:secret,kid2:secret2"'''
+    keys = {}
+    for entry in os.environ.get('ACCESS_TOKEN_KEYS', '').split(','):
+        key_id, _, secret = entry.strip().partition(':')
+        if key_id and secret:
+            keys[key_id] = secret.encode()
+    return keys
+
+ACCESS_TOKEN_KEYS = load_access_token_keys()
+
+def verify_access_token(token: str):
+    '''Проверяет подписанный access-токен без обращения к базе; возвращает id пользователя или None'''
+    try:
+        prefix, key_id, payload, signature = token.split('.')
+    except ValueError:
+        return None
+    key = ACCESS_TOKEN_KEYS.get(key_id)
+    if prefix != ACCESS_TOKEN_PREFIX or not key:
+        return None
+    
+    expected = hmac.new(key, f'{prefix}.{key_id}.{payload}'.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(base64.urlsafe_b64encode(expected).rstrip(b'='), signature.encode()):
+        return None
+    
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    if claims['exp'] <= time.time():
+        return None
+    return claims['uid']
+
+def authenticate(headers: dict):
+    '''Возвращает id пользователя по токену из X-Auth-Token.
+
+    Подписанные access-токены проверяются локально по HMAC. Если ACCESS_TOKEN_KEYS задан,
+    токены сессий (refresh) здесь не принимаются: их обменивает на access-токен только
+    auth?action=refresh. Без ключей токены сессий проверяются по базе.
+
+    Проверенные токены кэшируются в процессе (LRU + TTL), поэтому горячие пути опроса
+    не ходят в базу на каждый запрос; отзыв сессии виден не позже чем через SESSION_CACHE_TTL.
+    '''
+    token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+    if not token:
+        return None
+    if token.startswith(ACCESS_TOKEN_PREFIX + '.'):
+        return verify_access_token(token)
+    if ACCESS_TOKEN_KEYS:
+        return None
+    
+    token_hash = hash_token(token)
+    now = time.monotonic()
+    cached = _session_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _session_cache.move_to_end(token_hash)
+        return cached[0]
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT user_id, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+        FROM sessions
+        WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """, (token_hash,))
+    session = cur.fetchone()
+    cur.close()
+    conn.close()
+    
+    if not session:
+        _session_cache.pop(token_hash, None)
+        return None
+    
+    _session_cache[token_hash] = (session[0], now + min(SESSION_CACHE_TTL, float(session[1])))
+    _session_cache.move_to_end(token_hash)
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+    return session[0]
+
+def notify_event(cur, event_type: str, chat_channel: str = None, **payload):
+    '''Публикует событие для push-сервиса; доставляется только после commit'''
+    data = json.dumps({'type': event_type, **payload})
+    cur.execute("SELECT pg_notify(%s, %s)", (PUSH_CHANNEL, data))
+    if chat_channel:
+        cur.execute("SELECT pg_notify(%s, %s)", (chat_channel, data))
+
+def enqueue_event(cur, event_type: str, chat_channel: str = None, **payload):
+    '''Пишет событие в outbox в текущей транзакции и будит подписчиков через NOTIFY'''
+    cur.execute(
+        "INSERT INTO outbox (event_type, payload) VALUES (%s, %s) RETURNING id",
+        (event_type, json.dumps(payload))
+    )
+    notify_event(cur, event_type, chat_channel=chat_channel, outbox_id=cur.fetchone()[0], **payload)
+
+def parse_client_msg_id(value):
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+def lock_chat_for_send(cur, chat_id: int) -> bool:
+    '''Сериализует отправку в чат до commit: id выдаются и становятся видны в одном порядке.
+
+    Иначе курсоры after_id и last_read_message_id могут перескочить сообщение с меньшим id,
+    транзакция которого закоммитилась позже.
+    '''
+    # NO KEY UPDATE сериализует отправителей, но не блокирует FK-проверки (FOR KEY SHARE)
+    # при вставках в chat_members, call_sessions и другие таблицы со ссылкой на chats
+    cur.execute("SELECT id FROM chats WHERE id = %s FOR NO KEY UPDATE", (chat_id,))
+    return cur.fetchone() is not None
+
+def cursor_created_at(cur, chat_id: int, message_id: int):
+    '''created_at сообщения-курсора, чтобы ограничить выборку по ключу секционирования.
+
+    Обычно курсор указывает на последнее сообщение чата, и время берётся из chats без обхода
+    секций. id и created_at (clock_timestamp() под блокировкой чата) растут в чате согласованно.
+    '''
+    cur.execute("SELECT last_message_id, last_message_time FROM chats WHERE id = %s", (chat_id,))
+    chat = cur.fetchone()
+    if chat and chat[0] == message_id:
+        return chat[1]
+    cur.execute("SELECT created_at FROM messages WHERE chat_id = %s AND id = %s", (chat_id, message_id))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def claim_client_msg_ids(cur, chat_id: int, sender_id: int, client_msg_ids: list):
+    '''Резервирует id сообщений под ключи идемпотентности одним INSERT.
+
+    Возвращает (новый ключ -> зарезервированный id, повторный ключ -> (id, created_at) исходного сообщения).
+    '''
+    claimed = dict(execute_values(cur, """
+        INSERT INTO message_client_ids (chat_id, sender_id, client_msg_id, message_id)
+        VALUES %s
+        ON CONFLICT (chat_id, sender_id, client_msg_id) DO NOTHING
+        RETURNING client_msg_id, message_id
+    """, [(chat_id, sender_id, client_msg_id) for client_msg_id in client_msg_ids],
+        template="(%s, %s, %s, nextval('messages_id_seq'))", fetch=True))
+    
+    existing = {}
+    retried_ids = [client_msg_id for client_msg_id in client_msg_ids if client_msg_id not in claimed]
+    if retried_ids:
+        cur.execute("""
+            SELECT client_msg_id, message_id, created_at FROM message_client_ids
+            WHERE chat_id = %s AND sender_id = %s AND client_msg_id = ANY(%s::uuid[])
+        """, (chat_id, sender_id, retried_ids))
+        existing = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+    return claimed, existing
+
+def get_s3_client():
+    '''boto3 нужен только для чтения архивов, поэтому импортируется лениво'''
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client('s3',
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+    return _s3_client
+
+def read_archive(object_key: str) -> list:
+    '''Скачивает и распаковывает архив чата за месяц; последние архивы держим в памяти'''
+    records = _archive_cache.get(object_key)
+    if records is not None:
+        _archive_cache.move_to_end(object_key)
+        return records
+    
+    body = get_s3_client().get_object(Bucket=ARCHIVE_BUCKET, Key=object_key)['Body'].read()
+    records = [json.loads(line) for line in gzip.decompress(body).splitlines()]
+    _archive_cache[object_key] = records
+    while len(_archive_cache) > ARCHIVE_CACHE_SIZE:
+        _archive_cache.popitem(last=False)
+    return records
+
+def load_archived_rows(cur, chat_id: int, user_id: int, before_id: int, limit: int) -> list:
+    '''Сообщения из выгруженных секций в формате выборки из messages, от новых к старым.
+
+    Архивы лежат в закрытом бакете под случайными ключами, поэтому это единственный путь
+    к ним; ключи выдаются только участникам чата.
+    '''
+    cur.execute("""
+        SELECT a.object_key FROM message_archives a
+        WHERE a.chat_id = %s AND a.min_id < %s
+        AND EXISTS (SELECT 1 FROM chat_members cm WHERE cm.chat_id = a.chat_id AND cm.user_id = %s)
+        ORDER BY a.max_id DESC
+    """, (chat_id, before_id, user_id))
+    
+    records = []
+    for (object_key,) in cur.fetchall():
+        records.extend(record for record in reversed(read_archive(object_key)) if record['id'] < before_id)
+        if len(records) >= limit:
+            break
+    records = records[:limit]
+    if not records:
+        return []
+    
+    cur.execute("SELECT id, nickname FROM users WHERE id = ANY(%s)", (list({record['sender_id'] for record in records}),))
+    nicknames = dict(cur.fetchall())
+    return [
+        (record['id'], record['text'], record['type'], record['file_url'], datetime.fromisoformat(record['created_at']),
+         record['sender_id'], nicknames.get(record['sender_id']), record['file_preview'])
+        for record in records
+    ]
+
+def listen_channel(conn, channel: str):
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'LISTEN "{channel}"')
+    conn.autocommit = False
+
+def wait_for_notify(conn, timeout: float):
+    '''Блокирует запрос до NOTIFY по прослушиваемому каналу; возвращает события или None по таймауту'''
+    conn.rollback()
+    # NOTIFY, пришедший во время последнего запроса или ROLLBACK, libpq уже прочитал из сокета
+    conn.poll()
+    if not conn.notifies and select.select([conn], [], [], max(timeout, 0)) == ([], [], []):
+        return None
+    conn.poll()
+    events = [json.loads(notify.payload) for notify in conn.notifies]
+    conn.notifies.clear()
+    return events
+
+def unlisten_all(conn):
+    conn.rollback()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('UNLISTEN *')
+    conn.autocommit = False
+
+def remember_typing(chat_id: int, user_id: int, ttl: float = TYPING_TTL):
+    _typing_users.setdefault(chat_id, {})[user_id] = time.monotonic() + ttl
+
+def forget_typing(chat_id: int, user_id: int):
+    _typing_users.get(chat_id, {}).pop(user_id, None)
+
+def typing_users(chat_id: int, exclude_user_id: int) -> list:
+    '''Кто сейчас печатает в чате по данным этого инстанса; устаревшие записи удаляются'''
+    now = time.monotonic()
+    chat_typing = _typing_users.get(chat_id)
+    if not chat_typing:
+        return []
+    for typing_user_id, expires_at in list(chat_typing.items()):
+        if expires_at <= now:
+            del chat_typing[typing_user_id]
+    if not chat_typing:
+        del _typing_users[chat_id]
+        return []
+    return [typing_user_id for typing_user_id in chat_typing if typing_user_id != exclude_user_id]
+
+def allow_typing_event(chat_id: int, user_id: int) -> bool:
+    '''Не чаще одного события набора текста на пользователя в чате за TYPING_NOTIFY_INTERVAL'''
+    now = time.monotonic()
+    if len(_typing_notified_at) > TYPING_STATE_SIZE:
+        for key, notified_at in list(_typing_notified_at.items()):
+            if now - notified_at >= TYPING_NOTIFY_INTERVAL:
+                del _typing_notified_at[key]
+    
+    key = (chat_id, user_id)
+    if now - _typing_notified_at.get(key, float('-inf')) < TYPING_NOTIFY_INTERVAL:
+        return False
+    _typing_notified_at[key] = now
+    return True
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_messages(cur, user_id: int, query: str, chat_id: int = None) -> list:
+    '''Полнотекстовый поиск с ранжированием и подсветкой по чатам, где состоит пользователь.
+
+    Подстрочный ILIKE добавляется только для запросов от SEARCH_INFIX_MIN_LENGTH символов:
+    триграммный индекс не обслуживает более короткие шаблоны.
+    '''
+    match_filter = "m.search_vector @@ tsq.q"
+    if len(query) >= SEARCH_INFIX_MIN_LENGTH:
+        match_filter += " OR m.message_text ILIKE %(pattern)s"
+    
+    cur.execute(f"""
+        SELECT m.id, m.message_text, m.message_type, m.file_url, m.created_at, m.sender_id, u.nickname, m.file_preview, m.chat_id,
+            ts_headline('russian', m.message_text, tsq.q, 'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5')
+        FROM messages m
+        INNER JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = %(user_id)s
+        INNER JOIN users u ON u.id = m.sender_id
+        CROSS JOIN (SELECT plainto_tsquery('russian', %(query)s) || plainto_tsquery('simple', %(query)s) AS q) tsq
+        WHERE (%(chat_id)s::integer IS NULL OR m.chat_id = %(chat_id)s)
+        AND ({match_filter})
+        ORDER BY ts_rank(m.search_vector, tsq.q) DESC, m.id DESC
+        LIMIT %(limit)s
+    """, {
+        'user_id': user_id,
+        'query': query,
+        'chat_id': chat_id,
+        'pattern': f'%{escape_like(query)}%',
+        'limit': SEARCH_RESULTS_LIMIT
+    })
+    
+    return [{
+        'id': row[0],
+        'text': row[1],
+        'type': row[2],
+        'file_url': row[3],
+        'time': row[4].isoformat(),
+        'sender_id': row[5],
+        'sender_name': row[6],
+        'is_own': row[5] == user_id,
+        'preview': row[7],
+        'chat_id': row[8],
+        'snippet': row[9]
+    } for row in cur.fetchall()]
 
 def handler(event: dict, context) -> dict:
     '''API для работы с чатами и сообщениями'''
@@ -16,7 +545,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -24,8 +553,7 @@ def handler(event: dict, context) -> dict:
         }
     
     try:
-        headers = event.get('headers', {})
-        user_id = headers.get('X-User-Id') or headers.get('x-user-id')
+        user_id = authenticate(event.get('headers', {}))
         
         if not user_id:
             return {
@@ -35,7 +563,6 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        user_id = int(user_id)
         conn = get_db_connection()
         cur = conn.cursor()
         
@@ -44,44 +571,70 @@ def handler(event: dict, context) -> dict:
             
             if action == 'chats':
                 cur.execute("""
-                    SELECT DISTINCT 
-                        c.id, c.name, c.is_group, c.avatar_url,
-                        (SELECT message_text FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
-                        (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time,
-                        (SELECT COUNT(*) FROM messages WHERE chat_id = c.id AND sender_id != %s AND is_read = false) as unread_count
-                    FROM chats c
-                    INNER JOIN chat_members cm ON cm.chat_id = c.id
+                    SELECT c.id, c.is_group, c.last_message_id, rs.last_read_message_id
+                    FROM chat_members cm
+                    INNER JOIN chats c ON c.id = cm.chat_id
+                    LEFT JOIN chat_read_state rs ON rs.chat_id = cm.chat_id AND rs.user_id = cm.user_id
                     WHERE cm.user_id = %s
-                    ORDER BY last_message_time DESC NULLS LAST
-                """, (user_id, user_id))
+                    ORDER BY c.id
+                """, (user_id,))
+                
+                versions = cur.fetchall()
+                direct_chat_ids = [row[0] for row in versions if not row[1]]
+                members = chat_members_cache.get_many(direct_chat_ids, lambda ids: load_chat_members(cur, ids))
+                counterparts = {
+                    chat_id: next((member_id for member_id in members.get(chat_id, []) if member_id != user_id), None)
+                    for chat_id in direct_chat_ids
+                }
+                counterpart_ids = list({member_id for member_id in counterparts.values() if member_id is not None})
+                profiles = profile_cache.get_many(counterpart_ids, lambda ids: load_profile_cards(cur, ids))
+                
+                etag = build_etag('chats', user_id, versions, [
+                    (profile['id'], profile['nickname'], profile['avatar_url'], profile['is_online'], profile['status_text'], profile['status_emoji'])
+                    for profile in sorted(profiles.values(), key=lambda profile: profile['id'])
+                ])
+                if is_not_modified(event.get('headers') or {}, etag):
+                    cur.close()
+                    conn.close()
+                    return not_modified_response(etag)
+                
+                cur.execute("""
+                    SELECT c.id, c.name, c.is_group, c.avatar_url,
+                        c.last_message_text, c.last_message_time, unread.count
+                    FROM chat_members cm
+                    INNER JOIN chats c ON c.id = cm.chat_id
+                    LEFT JOIN chat_read_state rs ON rs.chat_id = cm.chat_id AND rs.user_id = cm.user_id
+                    CROSS JOIN LATERAL (
+                        SELECT COUNT(*) AS count FROM (
+                            SELECT 1 FROM messages m
+                            WHERE m.chat_id = c.id AND m.id > COALESCE(rs.last_read_message_id, 0)
+                            AND m.sender_id != cm.user_id
+                            LIMIT %s
+                        ) u
+                    ) unread
+                    WHERE cm.user_id = %s
+                    ORDER BY c.last_message_time DESC NULLS LAST
+                """, (UNREAD_COUNT_CAP, user_id))
                 
                 chats = []
                 for row in cur.fetchall():
                     chat_id = row[0]
                     
                     if not row[2]:
-                        cur.execute("""
-                            SELECT u.id, u.username, u.nickname, u.avatar_url, u.is_online, u.status_text, u.status_emoji
-                            FROM chat_members cm
-                            INNER JOIN users u ON u.id = cm.user_id
-                            WHERE cm.chat_id = %s AND cm.user_id != %s
-                            LIMIT 1
-                        """, (chat_id, user_id))
-                        other_user = cur.fetchone()
-                        
-                        if other_user:
+                        other = profiles.get(counterparts.get(chat_id))
+                        if other:
                             chats.append({
                                 'id': chat_id,
-                                'name': other_user[2],
-                                'avatar_url': other_user[3],
+                                'name': other['nickname'],
+                                'avatar_url': other['avatar_url'],
                                 'is_group': False,
                                 'last_message': row[4] or '',
                                 'last_message_time': row[5].isoformat() if row[5] else None,
                                 'unread_count': row[6],
-                                'online': other_user[4],
-                                'status_text': other_user[5],
-                                'status_emoji': other_user[6],
-                                'other_user_id': other_user[0]
+                                'online': other['is_online'],
+                                'status_text': other['status_text'],
+                                'status_emoji': other['status_emoji'],
+                                'other_user_id': other['id']
                             })
                     else:
                         chats.append({
@@ -100,14 +653,52 @@ def handler(event: dict, context) -> dict:
                 
                 return {
                     'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'headers': etag_headers(etag),
                     'body': json.dumps({'chats': chats}),
                     'isBase64Encoded': False
                 }
             
+            elif action == 'cache_stats':
+                cur.close()
+                conn.close()
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'profiles': profile_cache.stats(),
+                        'chat_members': chat_members_cache.stats()
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            elif action == 'search':
+                query = event.get('queryStringParameters', {}).get('query', '').strip()
+                if not query:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'query required'}),
+                        'isBase64Encoded': False
+                    }
+                
+                messages = search_messages(cur, user_id, query)
+                cur.close()
+                conn.close()
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'messages': messages}),
+                    'isBase64Encoded': False
+                }
+            
             elif action == 'messages':
                 chat_id = event.get('queryStringParameters', {}).get('chat_id')
                 search = event.get('queryStringParameters', {}).get('search', '').strip()
+                after_id = event.get('queryStringParameters', {}).get('after_id')
+                before_id = event.get('queryStringParameters', {}).get('before_id')
+                limit = event.get('queryStringParameters', {}).get('limit')
                 
                 if not chat_id:
                     return {
@@ -118,25 +709,133 @@ def handler(event: dict, context) -> dict:
                     }
                 
                 if search:
-                    cur.execute("""
-                        SELECT m.id, m.message_text, m.message_type, m.file_url, m.created_at, m.sender_id, u.nickname
-                        FROM messages m
-                        INNER JOIN users u ON u.id = m.sender_id
-                        WHERE m.chat_id = %s AND m.message_text ILIKE %s
-                        ORDER BY m.created_at DESC
-                        LIMIT 50
-                    """, (int(chat_id), f'%{search}%'))
+                    messages = search_messages(cur, user_id, search, int(chat_id))
+                    cur.close()
+                    conn.close()
+                    
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'messages': messages}),
+                        'isBase64Encoded': False
+                    }
+                
+                has_more = None
+                wait = min(float(event.get('queryStringParameters', {}).get('wait') or 0), LONG_POLL_MAX_WAIT) if after_id else 0
+                etag = None
+                
+                if wait <= 0:
+                    cur.execute("SELECT last_message_id FROM chats WHERE id = %s", (int(chat_id),))
+                    chat_version = cur.fetchone()
+                    etag = build_etag(
+                        'messages', user_id, event.get('queryStringParameters', {}),
+                        chat_version[0] if chat_version else None, typing_users(int(chat_id), user_id)
+                    )
+                    if is_not_modified(event.get('headers') or {}, etag):
+                        cur.close()
+                        conn.close()
+                        return not_modified_response(etag)
+                
+                if after_id:
+                    # Нижняя граница по created_at позволяет планировщику отсечь старые месячные секции
+                    after_time = cursor_created_at(cur, int(chat_id), int(after_id)) if int(after_id) else None
+                    time_filter = 'AND m.created_at >= %s' if after_time else ''
+                    time_params = (after_time - CURSOR_TIME_MARGIN,) if after_time else ()
+                    
+                    deadline = time.monotonic() + wait
+                    if wait > 0:
+                        listen_channel(conn, CHAT_CHANNEL.format(int(chat_id)))
+                    
+                    while True:
+                        cur.execute(f"""
+                            SELECT m.id, m.message_text, m.message_type, m.file_url, m.created_at, m.sender_id, u.nickname, m.file_preview
+                            FROM messages m
+                            INNER JOIN users u ON u.id = m.sender_id
+                            WHERE m.chat_id = %s AND m.id > %s {time_filter}
+                            ORDER BY m.id ASC
+                        """, (int(chat_id), int(after_id)) + time_params)
+                        
+                        rows = cur.fetchall()
+                        if rows or wait <= 0:
+                            break
+                        
+                        events = wait_for_notify(conn, deadline - time.monotonic())
+                        if events is None:
+                            break
+                        
+                        typing_changed = False
+                        has_new_message = False
+                        for notified in events:
+                            if notified.get('type') == 'typing':
+                                remember_typing(notified['chat_id'], notified['user_id'], notified['ttl'])
+                                typing_changed = True
+                            elif notified.get('type') == 'message':
+                                forget_typing(notified['chat_id'], notified['sender_id'])
+                                has_new_message = True
+                        if typing_changed and not has_new_message:
+                            break
+                    
+                    if wait > 0:
+                        unlisten_all(conn)
+                    
+                    if not rows:
+                        cur.close()
+                        conn.close()
+                        return {
+                            'statusCode': 200,
+                            'headers': etag_headers(etag) if etag else {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                            'body': json.dumps({
+                                'messages': [],
+                                'unchanged': True,
+                                'cursor': int(after_id),
+                                'typing': typing_users(int(chat_id), user_id)
+                            }),
+                            'isBase64Encoded': False
+                        }
+                elif limit or before_id:
+                    page_size = min(max(int(limit or MESSAGES_PAGE_SIZE), 1), MESSAGES_PAGE_MAX)
+                    
+                    if before_id:
+                        # Верхняя граница по created_at отсекает секции новее курсора
+                        before_time = cursor_created_at(cur, int(chat_id), int(before_id))
+                        time_filter = 'AND m.created_at <= %s' if before_time else ''
+                        time_params = (before_time + CURSOR_TIME_MARGIN,) if before_time else ()
+                        cur.execute(f"""
+                            SELECT m.id, m.message_text, m.message_type, m.file_url, m.created_at, m.sender_id, u.nickname, m.file_preview
+                            FROM messages m
+                            INNER JOIN users u ON u.id = m.sender_id
+                            WHERE m.chat_id = %s AND m.id < %s {time_filter}
+                            ORDER BY m.id DESC
+                            LIMIT %s
+                        """, (int(chat_id), int(before_id)) + time_params + (page_size + 1,))
+                    else:
+                        cur.execute("""
+                            SELECT m.id, m.message_text, m.message_type, m.file_url, m.created_at, m.sender_id, u.nickname, m.file_preview
+                            FROM messages m
+                            INNER JOIN users u ON u.id = m.sender_id
+                            WHERE m.chat_id = %s
+                            ORDER BY m.id DESC
+                            LIMIT %s
+                        """, (int(chat_id), page_size + 1))
+                    
+                    rows = cur.fetchall()
+                    if len(rows) <= page_size:
+                        archive_before_id = rows[-1][0] if rows else int(before_id or ARCHIVE_MAX_ID)
+                        rows += load_archived_rows(cur, int(chat_id), user_id, archive_before_id, page_size + 1 - len(rows))
+                    has_more = len(rows) > page_size
+                    rows = rows[:page_size][::-1]
                 else:
                     cur.execute("""
-                        SELECT m.id, m.message_text, m.message_type, m.file_url, m.created_at, m.sender_id, u.nickname
+                        SELECT m.id, m.message_text, m.message_type, m.file_url, m.created_at, m.sender_id, u.nickname, m.file_preview
                         FROM messages m
                         INNER JOIN users u ON u.id = m.sender_id
                         WHERE m.chat_id = %s
                         ORDER BY m.created_at ASC
                     """, (int(chat_id),))
+                    rows = cur.fetchall()
                 
                 messages = []
-                for row in cur.fetchall():
+                for row in rows:
                     messages.append({
                         'id': row[0],
                         'text': row[1],
@@ -145,22 +844,56 @@ def handler(event: dict, context) -> dict:
                         'time': row[4].isoformat(),
                         'sender_id': row[5],
                         'sender_name': row[6],
-                        'is_own': row[5] == user_id
+                        'is_own': row[5] == user_id,
+                        'preview': row[7]
                     })
                 
-                cur.execute("""
-                    UPDATE messages SET is_read = true 
-                    WHERE chat_id = %s AND sender_id != %s AND is_read = false
-                """, (int(chat_id), user_id))
-                conn.commit()
+                if before_id and has_more is not None:
+                    cur.close()
+                    conn.close()
+                    
+                    return {
+                        'statusCode': 200,
+                        'headers': etag_headers(etag),
+                        'body': json.dumps({
+                            'messages': messages,
+                            'has_more': has_more,
+                            'before_id': messages[0]['id'] if messages else None
+                        }),
+                        'isBase64Encoded': False
+                    }
+                
+                last_message_id = max((m['id'] for m in messages), default=int(after_id or 0))
+                
+                if last_message_id:
+                    cur.execute("""
+                        INSERT INTO chat_read_state (chat_id, user_id, last_read_message_id)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (chat_id, user_id) DO UPDATE
+                        SET last_read_message_id = EXCLUDED.last_read_message_id, updated_at = CURRENT_TIMESTAMP
+                        WHERE chat_read_state.last_read_message_id < EXCLUDED.last_read_message_id
+                    """, (int(chat_id), user_id, last_message_id))
+                    if cur.rowcount:
+                        notify_event(cur, 'read', chat_id=int(chat_id), user_id=user_id, last_read_message_id=last_message_id)
+                    conn.commit()
                 
                 cur.close()
                 conn.close()
                 
+                result = {
+                    'messages': messages,
+                    'unchanged': False,
+                    'cursor': last_message_id,
+                    'typing': typing_users(int(chat_id), user_id)
+                }
+                if has_more is not None:
+                    result['has_more'] = has_more
+                    result['before_id'] = messages[0]['id'] if messages else None
+                
                 return {
                     'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'messages': messages}),
+                    'headers': etag_headers(etag) if etag else {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps(result),
                     'isBase64Encoded': False
                 }
         
@@ -173,6 +906,8 @@ def handler(event: dict, context) -> dict:
                 message_text = body.get('message_text', '').strip()
                 message_type = body.get('message_type', 'text')
                 file_url = body.get('file_url')
+                file_id = body.get('file_id')
+                client_msg_id = body.get('client_msg_id')
                 
                 if not chat_id or (not message_text and not file_url):
                     return {
@@ -182,14 +917,69 @@ def handler(event: dict, context) -> dict:
                         'isBase64Encoded': False
                     }
                 
+                if client_msg_id is not None:
+                    client_msg_id = parse_client_msg_id(client_msg_id)
+                    if not client_msg_id:
+                        return {
+                            'statusCode': 400,
+                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                            'body': json.dumps({'error': 'client_msg_id must be a UUID'}),
+                            'isBase64Encoded': False
+                        }
+                
+                if not lock_chat_for_send(cur, int(chat_id)):
+                    cur.close()
+                    conn.close()
+                    return {
+                        'statusCode': 404,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Chat not found'}),
+                        'isBase64Encoded': False
+                    }
+                
+                message_id = None
+                if client_msg_id:
+                    claimed, existing = claim_client_msg_ids(cur, int(chat_id), user_id, [client_msg_id])
+                    if client_msg_id in existing:
+                        cur.close()
+                        conn.close()
+                        
+                        original_id, original_created_at = existing[client_msg_id]
+                        return {
+                            'statusCode': 200,
+                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                            'body': json.dumps({
+                                'success': True,
+                                'message_id': original_id,
+                                'created_at': original_created_at.isoformat(),
+                                'duplicate': True
+                            }),
+                            'isBase64Encoded': False
+                        }
+                    message_id = claimed[client_msg_id]
+                
                 cur.execute("""
-                    INSERT INTO messages (chat_id, sender_id, message_text, message_type, file_url)
-                    VALUES (%s, %s, %s, %s, %s)
+                    INSERT INTO messages (id, chat_id, sender_id, client_msg_id, message_text, message_type, file_url, file_id, created_at, file_preview)
+                    VALUES (COALESCE(%s, nextval('messages_id_seq')), %s, %s, %s, %s, %s, %s, %s, clock_timestamp(), (
+                        SELECT jsonb_build_object('thumbnails', thumbnails, 'placeholder', placeholder)
+                        FROM files WHERE id = %s AND thumbnails IS NOT NULL
+                    ))
                     RETURNING id, created_at
-                """, (chat_id, user_id, message_text, message_type, file_url))
+                """, (message_id, chat_id, user_id, client_msg_id, message_text, message_type, file_url, file_id, file_id))
                 
                 result = cur.fetchone()
+                
+                cur.execute("""
+                    UPDATE chats
+                    SET last_message_id = %s, last_message_text = %s, last_message_time = %s
+                    WHERE id = %s AND (last_message_id IS NULL OR last_message_id < %s)
+                """, (result[0], message_text, result[1], chat_id, result[0]))
+                enqueue_event(
+                    cur, 'message', chat_channel=CHAT_CHANNEL.format(int(chat_id)),
+                    chat_id=int(chat_id), message_id=result[0], sender_id=user_id, text=message_text, created_at=result[1].isoformat()
+                )
                 conn.commit()
+                forget_typing(int(chat_id), user_id)
                 cur.close()
                 conn.close()
                 
@@ -204,6 +994,131 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
+            elif action == 'send_messages':
+                chat_id = body.get('chat_id')
+                batch = body.get('messages') or []
+                
+                if not chat_id or not batch or len(batch) > SEND_BATCH_MAX:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': f'chat_id and 1-{SEND_BATCH_MAX} messages required'}),
+                        'isBase64Encoded': False
+                    }
+                
+                rows = {}
+                for item in batch:
+                    client_msg_id = parse_client_msg_id(item.get('client_msg_id'))
+                    message_text = (item.get('message_text') or '').strip()
+                    file_url = item.get('file_url')
+                    if not client_msg_id or (not message_text and not file_url):
+                        return {
+                            'statusCode': 400,
+                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                            'body': json.dumps({'error': 'client_msg_id and message required for every message'}),
+                            'isBase64Encoded': False
+                        }
+                    file_id = item.get('file_id')
+                    rows.setdefault(client_msg_id, (int(chat_id), user_id, client_msg_id, message_text, item.get('message_type', 'text'), file_url, file_id, file_id))
+                
+                if not lock_chat_for_send(cur, int(chat_id)):
+                    cur.close()
+                    conn.close()
+                    return {
+                        'statusCode': 404,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Chat not found'}),
+                        'isBase64Encoded': False
+                    }
+                
+                claimed, existing = claim_client_msg_ids(cur, int(chat_id), user_id, list(rows))
+                inserted = []
+                if claimed:
+                    inserted = execute_values(cur, """
+                        INSERT INTO messages (id, chat_id, sender_id, client_msg_id, message_text, message_type, file_url, file_id, created_at, file_preview)
+                        VALUES %s
+                        RETURNING id, created_at, client_msg_id, message_text
+                    """, [(claimed[client_msg_id],) + row for client_msg_id, row in rows.items() if client_msg_id in claimed],
+                        template="""(%s, %s, %s, %s, %s, %s, %s, %s, clock_timestamp(), (
+                        SELECT jsonb_build_object('thumbnails', thumbnails, 'placeholder', placeholder)
+                        FROM files WHERE id = %s AND thumbnails IS NOT NULL
+                    ))""", fetch=True)
+                
+                stored = {row[2]: (row[0], row[1], False) for row in inserted}
+                for client_msg_id, (message_id, created_at) in existing.items():
+                    stored[client_msg_id] = (message_id, created_at, True)
+                
+                if inserted:
+                    last_message = max(inserted, key=lambda row: row[0])
+                    cur.execute("""
+                        UPDATE chats
+                        SET last_message_id = %s, last_message_text = %s, last_message_time = %s
+                        WHERE id = %s AND (last_message_id IS NULL OR last_message_id < %s)
+                    """, (last_message[0], last_message[3], last_message[1], chat_id, last_message[0]))
+                    enqueue_event(
+                        cur, 'message', chat_channel=CHAT_CHANNEL.format(int(chat_id)),
+                        chat_id=int(chat_id), message_id=last_message[0], message_ids=sorted(row[0] for row in inserted), sender_id=user_id,
+                        text=last_message[3], created_at=last_message[1].isoformat()
+                    )
+                conn.commit()
+                forget_typing(int(chat_id), user_id)
+                cur.close()
+                conn.close()
+                
+                results = []
+                for client_msg_id in rows:
+                    message_id, created_at, duplicate = stored[client_msg_id]
+                    results.append({
+                        'client_msg_id': client_msg_id,
+                        'message_id': message_id,
+                        'created_at': created_at.isoformat(),
+                        'duplicate': duplicate
+                    })
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': True, 'messages': results}),
+                    'isBase64Encoded': False
+                }
+            
+            elif action == 'typing':
+                chat_id = body.get('chat_id')
+                
+                if not chat_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'chat_id required'}),
+                        'isBase64Encoded': False
+                    }
+                
+                members = chat_members_cache.get_many([int(chat_id)], lambda ids: load_chat_members(cur, ids))
+                if user_id not in members.get(int(chat_id), []):
+                    cur.close()
+                    conn.close()
+                    return {
+                        'statusCode': 403,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Forbidden'}),
+                        'isBase64Encoded': False
+                    }
+                
+                if allow_typing_event(int(chat_id), user_id):
+                    remember_typing(int(chat_id), user_id)
+                    notify_event(cur, 'typing', chat_channel=CHAT_CHANNEL.format(int(chat_id)), chat_id=int(chat_id), user_id=user_id, ttl=TYPING_TTL)
+                    conn.commit()
+                
+                cur.close()
+                conn.close()
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': True, 'ttl': TYPING_TTL}),
+                    'isBase64Encoded': False
+                }
+            
             elif action == 'mute_chat':
                 chat_id = body.get('chat_id')
                 is_muted = body.get('is_muted', True)
@@ -288,6 +1203,7 @@ def handler(event: dict, context) -> dict:
                     """, (chat_id, other_user_id))
                 
                 conn.commit()
+                chat_members_cache.invalidate(chat_id)
                 cur.close()
                 conn.close()
                 
@@ -0,0 +1,288 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import os
+import time
+import psycopg2
+import psycopg2.extensions
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+PUSH_CHANNEL = 'moonly_events'
+PUSH_HOST = os.environ.get('PUSH_HOST', '0.0.0.0')
+PUSH_PORT = int(os.environ.get('PUSH_PORT', '8080'))
+KEEPALIVE_INTERVAL = 25
+TOKEN_RECHECK_INTERVAL = 60
+OUTBOX_POLL_INTERVAL = 5
+OUTBOX_REPLAY_WINDOW = 60
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+ACCESS_TOKEN_PREFIX = 'at1'
+
+subscribers = {}
+delivered_outbox_ids = {}
+lookup_executor = ThreadPoolExecutor(max_workers=1)
+
+def get_db_connection(**options):
+    return psycopg2.connect(os.environ['DATABASE_URL'], **options)
+
+class LookupConnection:
+    '''Соединение для запросов из lookup_executor; после ошибки закрывается и открывается заново при следующем запросе'''
+
+    def __init__(self):
+        self.conn = None
+
+    def run(self, query, *args):
+        if self.conn is None or self.conn.closed:
+            self.conn = get_db_connection()
+        try:
+            return query(self.conn, *args)
+        except psycopg2.Error:
+            self.conn.close()
+            self.conn = None
+            raise
+
+def load_access_token_keys() -> dict:
+    keys = {}
+    for entry in os.environ.get('ACCESS_TOKEN_KEYS', '').split(','):
+        key_id, _, secret = entry.strip().partition(':')
+        if key_id and secret:
+            keys[key_id] = secret.encode()
+    return keys
+
+ACCESS_TOKEN_KEYS = load_access_token_keys()
+
+def verify_access_token(token: str):
+    '''Проверяет подписанный access-токен из auth без обращения к базе'''
+    try:
+        prefix, key_id, payload, signature = token.split('.')
+    except ValueError:
+        return None
+    key = ACCESS_TOKEN_KEYS.get(key_id)
+    if prefix != ACCESS_TOKEN_PREFIX or not key:
+        return None
+    expected = hmac.new(key, f'{prefix}.{key_id}.{payload}'.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(base64.urlsafe_b64encode(expected).rstrip(b'='), signature.encode()):
+        return None
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    return claims['uid'] if claims['exp'] > time.time() else None
+
+def fetch_session_user(conn, token: str):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT user_id FROM sessions
+            WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+        """, (hashlib.sha256(token.encode()).hexdigest(),))
+        session = cur.fetchone()
+    conn.rollback()
+    return session[0] if session else None
+
+def fetch_chat_members(conn, chat_id: int) -> list:
+    with conn.cursor() as cur:
+        cur.execute("SELECT user_id FROM chat_members WHERE chat_id = %s", (chat_id,))
+        members = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    return members
+
+def fetch_recent_outbox(conn) -> list:
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, event_type, payload FROM outbox
+            WHERE created_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+            ORDER BY id
+        """, (OUTBOX_REPLAY_WINDOW,))
+        rows = cur.fetchall()
+    conn.rollback()
+    return rows
+
+async def resolve_recipients(lookup: LookupConnection, event: dict) -> list:
+    '''Определяет пользователей, которым нужно доставить событие'''
+    event_type = event.get('type')
+
+    if event_type == 'friend_request':
+        return [event['to_user_id']]
+
+    if event_type == 'call':
+        return [event['caller_id'], event['receiver_id']]
+
+    if event_type in ('message', 'read', 'typing'):
+        members = await asyncio.get_running_loop().run_in_executor(lookup_executor, lookup.run, fetch_chat_members, event['chat_id'])
+        return [member_id for member_id in members if member_id in subscribers]
+
+    return []
+
+async def dispatch(lookup: LookupConnection, raw_payload: str):
+    try:
+        event = json.loads(raw_payload)
+        outbox_id = event.get('outbox_id')
+        if outbox_id in delivered_outbox_ids:
+            return
+        recipients = await resolve_recipients(lookup, event)
+    except Exception as e:
+        print(f'push: failed to dispatch event: {e}')
+        return
+    
+    # Отмечаем только после успешного поиска получателей, иначе replay_outbox не дошлёт событие;
+    # повторная проверка — на случай, если replay и NOTIFY разослали его параллельно
+    if outbox_id in delivered_outbox_ids:
+        return
+    if outbox_id:
+        delivered_outbox_ids[outbox_id] = time.monotonic()
+
+    frame = f"event: {event['type']}\ndata: {raw_payload}\n\n".encode()
+    for recipient_id in recipients:
+        for queue in subscribers.get(recipient_id, ()):
+            queue.put_nowait(frame)
+
+async def replay_outbox(lookup: LookupConnection):
+    '''Досылает события из outbox, чьи NOTIFY потерялись (например, при переподключении)'''
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+        try:
+            rows = await loop.run_in_executor(lookup_executor, lookup.run, fetch_recent_outbox)
+        except psycopg2.Error as e:
+            print(f'push: failed to read outbox: {e}')
+            continue
+
+        for outbox_id, event_type, payload in rows:
+            if outbox_id not in delivered_outbox_ids:
+                await dispatch(lookup, json.dumps({'type': event_type, 'outbox_id': outbox_id, **payload}))
+
+        expired_before = time.monotonic() - 2 * OUTBOX_REPLAY_WINDOW
+        for outbox_id, delivered_at in list(delivered_outbox_ids.items()):
+            if delivered_at < expired_before:
+                del delivered_outbox_ids[outbox_id]
+
+def connect_listener() -> psycopg2.extensions.connection:
+    listen_conn = get_db_connection(keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+    listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with listen_conn.cursor() as cur:
+        cur.execute(f'LISTEN {PUSH_CHANNEL}')
+    return listen_conn
+
+async def listen(lookup: LookupConnection):
+    '''Подписывается на LISTEN и раздаёт уведомления без опроса базы; после обрыва переподключается с нарастающей паузой'''
+    loop = asyncio.get_running_loop()
+    delay = RECONNECT_MIN_DELAY
+    while True:
+        try:
+            listen_conn = await loop.run_in_executor(None, connect_listener)
+        except psycopg2.Error as e:
+            print(f'push: failed to connect listener, retrying in {delay}s: {e}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            continue
+        delay = RECONNECT_MIN_DELAY
+
+        lost = loop.create_future()
+
+        def on_readable():
+            try:
+                listen_conn.poll()
+            except psycopg2.Error as e:
+                if not lost.done():
+                    lost.set_result(e)
+                return
+            while listen_conn.notifies:
+                notify = listen_conn.notifies.pop(0)
+                loop.create_task(dispatch(lookup, notify.payload))
+
+        fileno = listen_conn.fileno()
+        loop.add_reader(fileno, on_readable)
+        error = await lost
+        loop.remove_reader(fileno)
+        listen_conn.close()
+        print(f'push: lost listener connection, reconnecting: {error}')
+
+async def authenticate_token(lookup: LookupConnection, token: str):
+    if token.startswith(ACCESS_TOKEN_PREFIX + '.'):
+        return verify_access_token(token)
+    if ACCESS_TOKEN_KEYS:
+        return None
+    return await asyncio.get_running_loop().run_in_executor(lookup_executor, lookup.run, fetch_session_user, token)
+
+async def is_token_still_valid(lookup: LookupConnection, token: str, user_id: int) -> bool:
+    '''Повторная проверка открытого потока: после logout, отзыва сессии или истечения access-токена поток закрывается'''
+    try:
+        return await authenticate_token(lookup, token) == user_id
+    except psycopg2.Error as e:
+        print(f'push: failed to recheck token, keeping stream open: {e}')
+        return True
+
+async def write_response_head(writer: asyncio.StreamWriter, status: str, headers: dict):
+    lines = [f'HTTP/1.1 {status}'] + [f'{name}: {value}' for name, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    await writer.drain()
+
+async def handle_client(lookup: LookupConnection, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    '''Отдаёт поток событий в формате Server-Sent Events: GET /events?token=...'''
+    try:
+        request_line = (await reader.readline()).decode()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+
+        method, target, _ = request_line.split(' ', 2)
+        url = urlsplit(target)
+        token = parse_qs(url.query).get('token', [''])[0]
+        user_id = None
+        if method == 'GET' and url.path == '/events' and token:
+            user_id = await authenticate_token(lookup, token)
+
+        if not user_id:
+            await write_response_head(writer, '401 Unauthorized', {
+                'Content-Length': '0',
+                'Access-Control-Allow-Origin': '*'
+            })
+            writer.close()
+            return
+    except (ValueError, ConnectionError, psycopg2.Error):
+        writer.close()
+        return
+
+    await write_response_head(writer, '200 OK', {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive',
+        'Access-Control-Allow-Origin': '*'
+    })
+
+    queue = asyncio.Queue()
+    subscribers.setdefault(user_id, set()).add(queue)
+    checked_at = time.monotonic()
+
+    try:
+        while True:
+            try:
+                frame = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                frame = b': keepalive\n\n'
+            if time.monotonic() - checked_at >= TOKEN_RECHECK_INTERVAL:
+                if not await is_token_still_valid(lookup, token, user_id):
+                    break
+                checked_at = time.monotonic()
+            writer.write(frame)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        subscribers[user_id].discard(queue)
+        if not subscribers[user_id]:
+            del subscribers[user_id]
+        writer.close()
+
+async def main():
+    lookup = LookupConnection()
+    loop = asyncio.get_running_loop()
+    loop.create_task(listen(lookup))
+    loop.create_task(replay_outbox(lookup))
+    server = await asyncio.start_server(functools.partial(handle_client, lookup), PUSH_HOST, PUSH_PORT)
+    print(f'push: listening on {PUSH_HOST}:{PUSH_PORT}')
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    asyncio.run(main())
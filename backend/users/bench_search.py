@@ -0,0 +1,113 @@
+'''Бенчмарк users?action=search на сгенерированной таблице пользователей.
+
+Запускать только на отдельной базе с применёнными миграциями: --generate добавляет в users
+строки bench_* (по умолчанию миллион) и сессию для запросов. Затем через handler() гоняются
+префиксные и подстрочные запросы разной длины, включая вторую страницу по курсору;
+скрипт печатает p50/p99 и завершается с кодом 1, если p99 выше --target-p99.
+
+    DATABASE_URL=postgres://... python bench_search.py --generate 1000000 --target-p99 50
+'''
+import argparse
+import hashlib
+import json
+import os
+import random
+import secrets
+import statistics
+import sys
+import time
+
+os.environ.pop('ACCESS_TOKEN_KEYS', None)
+
+from index import get_db_connection, handler
+
+SYLLABLES = ['lu', 'na', 'mo', 'ri', 'ka', 'so', 'te', 'vi', 'da', 'ne', 'ol', 'ya']
+BENCH_PASSWORD_HASH = 'bench'
+
+def generate_users(count: int):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO users (username, nickname, email, password_hash)
+        SELECT 'bench_' || i || '_' || substr(md5(i::text), 1, 6),
+            initcap(s[1 + i % 12] || s[1 + (i / 12) % 12] || s[1 + (i / 144) % 12]) || ' ' || initcap(s[1 + (i / 1728) % 12] || s[1 + (i * 7) % 12]),
+            'bench_' || i || '@bench.invalid',
+            %s
+        FROM generate_series(1, %s) AS i, (SELECT %s::text[] AS s) syllables
+        ON CONFLICT DO NOTHING
+    """, (BENCH_PASSWORD_HASH, count, SYLLABLES))
+    conn.commit()
+    cur.execute('ANALYZE users')
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def create_bench_session() -> str:
+    token = secrets.token_urlsafe(32)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE password_hash = %s ORDER BY id LIMIT 1", (BENCH_PASSWORD_HASH,))
+    row = cur.fetchone()
+    if not row:
+        sys.exit('no bench users found, run with --generate first')
+    cur.execute(
+        "INSERT INTO sessions (user_id, token_hash, expires_at) VALUES (%s, %s, CURRENT_TIMESTAMP + INTERVAL '1 hour')",
+        (row[0], hashlib.sha256(token.encode()).hexdigest())
+    )
+    conn.commit()
+    cur.close()
+    conn.close()
+    return token
+
+def build_queries(count: int) -> list:
+    rng = random.Random(42)
+    queries = []
+    for _ in range(count):
+        word = ''.join(rng.choice(SYLLABLES) for _ in range(3))
+        length = rng.randint(1, 6)
+        # Половина запросов — префикс, половина — подстрока из середины имени
+        queries.append(word[:length] if rng.random() < 0.5 else word[1:1 + length])
+    return queries
+
+def search(token: str, query: str, cursor: str = None):
+    params = {'action': 'search', 'query': query}
+    if cursor:
+        params['cursor'] = cursor
+    started = time.perf_counter()
+    response = handler({'httpMethod': 'GET', 'queryStringParameters': params, 'headers': {'X-Auth-Token': token}}, None)
+    elapsed = (time.perf_counter() - started) * 1000
+    if response['statusCode'] != 200:
+        sys.exit(f'search failed: {response["body"]}')
+    return elapsed, json.loads(response['body']).get('next_cursor')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--generate', type=int, default=0, metavar='USERS')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--target-p99', type=float, default=50.0, metavar='MS')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit('DATABASE_URL is required')
+
+    if args.generate:
+        started = time.perf_counter()
+        generate_users(args.generate)
+        print(f'generated {args.generate} users in {time.perf_counter() - started:.1f} s')
+
+    token = create_bench_session()
+    latencies = []
+    for query in build_queries(args.queries):
+        elapsed, next_cursor = search(token, query)
+        latencies.append(elapsed)
+        if next_cursor:
+            latencies.append(search(token, query, next_cursor)[0])
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f'{len(latencies)} requests: p50 {statistics.median(latencies):.1f} ms, p99 {p99:.1f} ms, target {args.target_p99:.0f} ms')
+    if p99 > args.target_p99:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
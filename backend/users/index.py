@@ -1,9 +1,340 @@
 import json
 import os
+import hashlib
+import hmac
+import base64
+import time
 import psycopg2
+import psycopg2.extensions
+from collections import OrderedDict
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_CHECK_INTERVAL = 30
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_SIZE = 10000
+ACCESS_TOKEN_PREFIX = 'at1'
+PUSH_CHANNEL = 'moonly_events'
+USER_SEARCH_PAGE_SIZE = 20
+USER_SEARCH_INFIX_MIN_LENGTH = 3
+PRESENCE_ONLINE_WINDOW = 120
+PRESENCE_FLUSH_INTERVAL = 60
+PRESENCE_BATCH_INTERVAL = 10
+PROFILE_CACHE_TTL = 30
+CHAT_MEMBERS_CACHE_TTL = 300
+CACHE_MAX_SIZE = 10000
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+
+_db_pool = []
+_session_cache = OrderedDict()
+_pending_heartbeats = {}
+_heartbeats_flushed_at = {}
+_presence_batch_at = 0.0
+_redis_client = None
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение, которое при close() возвращается в пул для следующих вызовов'''
+
+    def close(self):
+        if self.closed or len(_db_pool) >= DB_POOL_SIZE:
+            return super().close()
+        try:
+            self.rollback()
+        except psycopg2.Error:
+            return super().close()
+        self.released_at = time.monotonic()
+        _db_pool.append(self)
+
+    def discard(self):
+        super().close()
+
+def is_connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < DB_POOL_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    while _db_pool:
+        conn = _db_pool.pop()
+        if is_connection_alive(conn):
+            return conn
+        conn.discard()
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PooledConnection)
+
+def get_redis_client():
+    '''Redis-совместимое хранилище для кэша включается через CACHE_REDIS_URL; redis импортируется лениво'''
+    global _redis_client
+    if CACHE_REDIS_URL and _redis_client is None:
+        import redis
+        _redis_client = redis.Redis.from_url(CACHE_REDIS_URL)
+    return _redis_client
+
+class ReadThroughCache:
+    '''LRU + TTL кэш в памяти инстанса; с CACHE_REDIS_URL значения лежат в Redis и общие для всех инстансов'''
+
+    def __init__(self, namespace: str, ttl: int, max_size: int = CACHE_MAX_SIZE):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys: list, load) -> dict:
+        '''Возвращает значения по ключам; промахи догружаются одним вызовом load(missing_keys)'''
+        found = self._read(keys)
+        missing = [key for key in keys if key not in found]
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            loaded = load(missing)
+            self._write(loaded)
+            found.update(loaded)
+        return found
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+        redis_client = get_redis_client()
+        if redis_client and keys:
+            redis_client.delete(*[self._redis_key(key) for key in keys])
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'redis' if CACHE_REDIS_URL else 'memory',
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+    def _redis_key(self, key) -> str:
+        return f'moonly:{self.namespace}:{key}'
+
+    def _read(self, keys: list) -> dict:
+        redis_client = get_redis_client()
+        if redis_client:
+            values = redis_client.mget([self._redis_key(key) for key in keys])
+            return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+        
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(key)
+                found[key] = entry[0]
+        return found
+
+    def _write(self, values: dict):
+        redis_client = get_redis_client()
+        if redis_client:
+            pipeline = redis_client.pipeline()
+            for key, value in values.items():
+                pipeline.set(self._redis_key(key), json.dumps(value), ex=self.ttl)
+            pipeline.execute()
+            return
+        
+        expires_at = time.monotonic() + self.ttl
+        for key, value in values.items():
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+profile_cache = ReadThroughCache('profile', PROFILE_CACHE_TTL)
+chat_members_cache = ReadThroughCache('chat_members', CHAT_MEMBERS_CACHE_TTL)
+
+def load_profile_cards(cur, user_ids: list) -> dict:
+    cur.execute("""
+        SELECT id, username, nickname, email, avatar_url, status_text, status_emoji,
+            last_seen > CURRENT_TIMESTAMP - %s * INTERVAL '1 second', last_seen
+        FROM users
+        WHERE id = ANY(%s)
+    """, (PRESENCE_ONLINE_WINDOW, user_ids))
+    return {
+        row[0]: {
+            'id': row[0],
+            'username': row[1],
+            'nickname': row[2],
+            'email': row[3],
+            'avatar_url': row[4],
+            'status_text': row[5],
+            'status_emoji': row[6],
+            'is_online': row[7],
+            'last_seen': row[8].isoformat() if row[8] else None
+        }
+        for row in cur.fetchall()
+    }
+
+def load_chat_members(cur, chat_ids: list) -> dict:
+    cur.execute("""
+        SELECT chat_id, array_agg(user_id ORDER BY user_id)
+        FROM chat_members
+        WHERE chat_id = ANY(%s)
+        GROUP BY chat_id
+    """, (chat_ids,))
+    return {row[0]: row[1] for row in cur.fetchall()}
+
+def build_etag(*parts) -> str:
+    '''Слабый тег версии ответа: хэш от дешёвых признаков изменения, а не от тела'''
+    return 'W/"' + hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest() + '"'
+
+def is_not_modified(headers: dict, etag: str) -> bool:
+    value = headers.get('If-None-Match') or headers.get('if-none-match') or ''
+    return etag.removeprefix('W/') in (candidate.strip().removeprefix('W/') for candidate in value.split(','))
+
+def etag_headers(etag: str) -> dict:
+    return {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'no-cache',
+        'ETag': etag
+    }
+
+def not_modified_response(etag: str) -> dict:
+    return {
+        'statusCode': 304,
+        'headers': {'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag', 'ETag': etag},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def load_access_token_keys() -> dict:
+    '''Ключи подписи access-токенов из ACCESS_TOKEN_KEYS="kid:secret,kid2:secret2"'''
+    keys = {}
+    for entry in os.environ.get('ACCESS_TOKEN_KEYS', '').split(','):
+        key_id, _, secret = entry.strip().partition(':')
+        if key_id and secret:
+            keys[key_id] = secret.encode()
+    return keys
+
+ACCESS_TOKEN_KEYS = load_access_token_keys()
+
+def verify_access_token(token: str):
+    '''Проверяет подписанный access-токен без обращения к базе; возвращает id пользователя или None'''
+    try:
+        prefix, key_id, payload, signature = token.split('.')
+    except ValueError:
+        return None
+    key = ACCESS_TOKEN_KEYS.get(key_id)
+    if prefix != ACCESS_TOKEN_PREFIX or not key:
+        return None
+    
+    expected = hmac.new(key, f'{prefix}.{key_id}.{payload}'.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(base64.urlsafe_b64encode(expected).rstrip(b'='), signature.encode()):
+        return None
+    
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    if claims['exp'] <= time.time():
+        return None
+    return claims['uid']
+
+def authenticate(headers: dict):
+    '''Возвращает id пользователя по токену из X-Auth-Token.
+
+    Подписанные access-токены проверяются локально по HMAC. Если ACCESS_TOKEN_KEYS задан,
+    токены сессий (refresh) здесь не принимаются: их обменивает на access-токен только
+    auth?action=refresh. Без ключей токены сессий проверяются по базе.
+
+    Проверенные токены кэшируются в процессе (LRU + TTL), поэтому горячие пути опроса
+    не ходят в базу на каждый запрос; отзыв сессии виден не позже чем через SESSION_CACHE_TTL.
+    '''
+    token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+    if not token:
+        return None
+    if token.startswith(ACCESS_TOKEN_PREFIX + '.'):
+        return verify_access_token(token)
+    if ACCESS_TOKEN_KEYS:
+        return None
+    
+    token_hash = hash_token(token)
+    now = time.monotonic()
+    cached = _session_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _session_cache.move_to_end(token_hash)
+        return cached[0]
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT user_id, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+        FROM sessions
+        WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """, (token_hash,))
+    session = cur.fetchone()
+    cur.close()
+    conn.close()
+    
+    if not session:
+        _session_cache.pop(token_hash, None)
+        return None
+    
+    _session_cache[token_hash] = (session[0], now + min(SESSION_CACHE_TTL, float(session[1])))
+    _session_cache.move_to_end(token_hash)
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+    return session[0]
+
+def notify_event(cur, event_type: str, **payload):
+    '''Публикует событие для push-сервиса; доставляется только после commit'''
+    cur.execute("SELECT pg_notify(%s, %s)", (PUSH_CHANNEL, json.dumps({'type': event_type, **payload})))
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def encode_search_cursor(match_rank: int, friend_rank: int, username_key: str, user_id: int) -> str:
+    raw = json.dumps([match_rank, friend_rank, username_key, user_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_search_cursor(cursor: str):
+    try:
+        match_rank, friend_rank, username_key, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(match_rank), int(friend_rank), str(username_key), int(user_id)
+    except (ValueError, TypeError):
+        return None
+
+def flush_heartbeats(cur) -> bool:
+    '''Пишет накопленные heartbeat'ы в last_seen одним UPDATE.
+
+    Батч собирается не чаще раза в PRESENCE_BATCH_INTERVAL, а каждый пользователь попадает
+    в него не чаще раза в PRESENCE_FLUSH_INTERVAL; остальные пинги только обновляют память.
+    '''
+    global _presence_batch_at
+    now = time.monotonic()
+    if now - _presence_batch_at < PRESENCE_BATCH_INTERVAL:
+        return False
+    _presence_batch_at = now
+    
+    for flushed_user_id, flushed_at in list(_heartbeats_flushed_at.items()):
+        if now - flushed_at >= PRESENCE_FLUSH_INTERVAL:
+            del _heartbeats_flushed_at[flushed_user_id]
+    
+    due_user_ids = [uid for uid in _pending_heartbeats if uid not in _heartbeats_flushed_at]
+    if not due_user_ids:
+        return False
+    
+    ages = [now - _pending_heartbeats.pop(uid) for uid in due_user_ids]
+    cur.execute("""
+        UPDATE users u
+        SET last_seen = GREATEST(u.last_seen, CURRENT_TIMESTAMP - beat.age * INTERVAL '1 second')
+        FROM unnest(%s::int[], %s::float8[]) AS beat(user_id, age)
+        WHERE u.id = beat.user_id
+    """, (due_user_ids, ages))
+    for uid in due_user_ids:
+        _heartbeats_flushed_at[uid] = now
+    profile_cache.invalidate(*due_user_ids)
+    return True
 
 def handler(event: dict, context) -> dict:
     '''API для работы с пользователями и друзьями'''
@@ -15,7 +346,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -23,8 +354,7 @@ def handler(event: dict, context) -> dict:
         }
     
     try:
-        headers = event.get('headers', {})
-        user_id = headers.get('X-User-Id') or headers.get('x-user-id')
+        user_id = authenticate(event.get('headers', {}))
         
         if not user_id:
             return {
@@ -34,7 +364,6 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        user_id = int(user_id)
         conn = get_db_connection()
         cur = conn.cursor()
         
@@ -51,15 +380,73 @@ def handler(event: dict, context) -> dict:
                         'isBase64Encoded': False
                     }
                 
-                cur.execute("""
-                    SELECT id, username, nickname, avatar_url, is_online, status_text, status_emoji
-                    FROM users
-                    WHERE (username ILIKE %s OR nickname ILIKE %s) AND id != %s
-                    LIMIT 20
-                """, (f'%{query}%', f'%{query}%', user_id))
+                search_cursor = event.get('queryStringParameters', {}).get('cursor')
+                query_lower = query.lower()
+                params = {
+                    'user_id': user_id,
+                    'query': query_lower,
+                    'prefix': f'{escape_like(query_lower)}%',
+                    'pattern': f'%{escape_like(query)}%',
+                    'limit': USER_SEARCH_PAGE_SIZE + 1,
+                    'online_window': PRESENCE_ONLINE_WINDOW
+                }
+                
+                if len(query) >= USER_SEARCH_INFIX_MIN_LENGTH:
+                    match_filter = "u.username ILIKE %(pattern)s OR u.nickname ILIKE %(pattern)s"
+                else:
+                    match_filter = "lower(u.username) LIKE %(prefix)s OR lower(u.nickname) LIKE %(prefix)s"
+                
+                cursor_filter = ''
+                if search_cursor:
+                    decoded_cursor = decode_search_cursor(search_cursor)
+                    if not decoded_cursor:
+                        cur.close()
+                        conn.close()
+                        return {
+                            'statusCode': 400,
+                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                            'body': json.dumps({'error': 'invalid cursor'}),
+                            'isBase64Encoded': False
+                        }
+                    params['after_rank'], params['after_friend_rank'], params['after_username'], params['after_id'] = decoded_cursor
+                    cursor_filter = """
+                        WHERE (match_rank, friend_rank, username_key, id)
+                            > (%(after_rank)s, %(after_friend_rank)s, %(after_username)s, %(after_id)s)
+                    """
+                
+                cur.execute(f"""
+                    SELECT * FROM (
+                        SELECT u.id, u.username, u.nickname, u.avatar_url,
+                            u.last_seen > CURRENT_TIMESTAMP - %(online_window)s * INTERVAL '1 second' AS online,
+                            u.status_text, u.status_emoji,
+                            CASE
+                                WHEN lower(u.username) = %(query)s OR lower(u.nickname) = %(query)s THEN 0
+                                WHEN lower(u.username) LIKE %(prefix)s OR lower(u.nickname) LIKE %(prefix)s THEN 1
+                                ELSE 2
+                            END AS match_rank,
+                            CASE WHEN EXISTS (
+                                SELECT 1 FROM friend_requests fr
+                                WHERE fr.status = 'accepted'
+                                AND ((fr.from_user_id = %(user_id)s AND fr.to_user_id = u.id)
+                                    OR (fr.to_user_id = %(user_id)s AND fr.from_user_id = u.id))
+                            ) THEN 0 ELSE 1 END AS friend_rank,
+                            lower(u.username) AS username_key
+                        FROM users u
+                        WHERE ({match_filter}) AND u.id != %(user_id)s
+                    ) found
+                    {cursor_filter}
+                    ORDER BY match_rank, friend_rank, username_key, id
+                    LIMIT %(limit)s
+                """, params)
+                
+                rows = cur.fetchall()
+                next_cursor = None
+                if len(rows) > USER_SEARCH_PAGE_SIZE:
+                    rows = rows[:USER_SEARCH_PAGE_SIZE]
+                    next_cursor = encode_search_cursor(rows[-1][7], rows[-1][8], rows[-1][9], rows[-1][0])
                 
                 users = []
-                for row in cur.fetchall():
+                for row in rows:
                     users.append({
                         'id': row[0],
                         'username': row[1],
@@ -67,7 +454,8 @@ def handler(event: dict, context) -> dict:
                         'avatar_url': row[3],
                         'is_online': row[4],
                         'status_text': row[5],
-                        'status_emoji': row[6]
+                        'status_emoji': row[6],
+                        'is_friend': row[8] == 0
                     })
                 
                 cur.close()
@@ -76,7 +464,21 @@ def handler(event: dict, context) -> dict:
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'users': users}),
+                    'body': json.dumps({'users': users, 'next_cursor': next_cursor}),
+                    'isBase64Encoded': False
+                }
+            
+            elif action == 'cache_stats':
+                cur.close()
+                conn.close()
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'profiles': profile_cache.stats(),
+                        'chat_members': chat_members_cache.stats()
+                    }),
                     'isBase64Encoded': False
                 }
             
@@ -117,13 +519,7 @@ def handler(event: dict, context) -> dict:
                 else:
                     profile_user_id = user_id
                 
-                cur.execute("""
-                    SELECT id, username, nickname, email, avatar_url, status_text, status_emoji, is_online, last_seen
-                    FROM users
-                    WHERE id = %s
-                """, (profile_user_id,))
-                
-                user = cur.fetchone()
+                user = profile_cache.get_many([profile_user_id], lambda ids: load_profile_cards(cur, ids)).get(profile_user_id)
                 if not user:
                     cur.close()
                     conn.close()
@@ -137,21 +533,15 @@ def handler(event: dict, context) -> dict:
                 cur.close()
                 conn.close()
                 
+                etag = build_etag('profile', profile_user_id == user_id, user)
+                if is_not_modified(event.get('headers') or {}, etag):
+                    return not_modified_response(etag)
+                
                 return {
                     'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'headers': etag_headers(etag),
                     'body': json.dumps({
-                        'user': {
-                            'id': user[0],
-                            'username': user[1],
-                            'nickname': user[2],
-                            'email': user[3] if profile_user_id == user_id else None,
-                            'avatar_url': user[4],
-                            'status_text': user[5],
-                            'status_emoji': user[6],
-                            'is_online': user[7],
-                            'last_seen': user[8].isoformat() if user[8] else None
-                        }
+                        'user': {**user, 'email': user['email'] if profile_user_id == user_id else None}
                     }),
                     'isBase64Encoded': False
                 }
@@ -160,7 +550,22 @@ def handler(event: dict, context) -> dict:
             body = json.loads(event.get('body', '{}'))
             action = body.get('action')
             
-            if action == 'update_profile':
+            if action == 'heartbeat':
+                _pending_heartbeats[user_id] = time.monotonic()
+                if flush_heartbeats(cur):
+                    conn.commit()
+                
+                cur.close()
+                conn.close()
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': True}),
+                    'isBase64Encoded': False
+                }
+            
+            elif action == 'update_profile':
                 nickname = body.get('nickname')
                 avatar_url = body.get('avatar_url')
                 status_text = body.get('status_text')
@@ -198,6 +603,7 @@ def handler(event: dict, context) -> dict:
                 
                 cur.execute(query, params)
                 conn.commit()
+                profile_cache.invalidate(user_id)
                 cur.close()
                 conn.close()
                 
@@ -250,6 +656,7 @@ def handler(event: dict, context) -> dict:
                         RETURNING id
                     """, (user_id, to_user_id))
                     request_id = cur.fetchone()[0]
+                    notify_event(cur, 'friend_request', request_id=request_id, from_user_id=user_id, to_user_id=to_user_id)
                     conn.commit()
                     
                     cur.close()
@@ -318,6 +725,7 @@ def handler(event: dict, context) -> dict:
                 """, (chat_id, user_id, chat_id, from_user_id))
                 
                 conn.commit()
+                chat_members_cache.invalidate(chat_id)
                 cur.close()
                 conn.close()
                 
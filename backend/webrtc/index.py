@@ -1,10 +1,177 @@
 import json
 import os
+import hashlib
+import hmac
+import base64
+import select
+import time
 import psycopg2
+import psycopg2.extensions
+from collections import OrderedDict
 from datetime import datetime
 
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_CHECK_INTERVAL = 30
+SESSION_CACHE_TTL = 60
+SESSION_CACHE_SIZE = 10000
+ACCESS_TOKEN_PREFIX = 'at1'
+PUSH_CHANNEL = 'moonly_events'
+CALL_CHANNEL = 'moonly_call_{}'
+LONG_POLL_MAX_WAIT = 25
+
+_db_pool = []
+_session_cache = OrderedDict()
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение, которое при close() возвращается в пул для следующих вызовов'''
+
+    def close(self):
+        if self.closed or len(_db_pool) >= DB_POOL_SIZE:
+            return super().close()
+        try:
+            self.rollback()
+        except psycopg2.Error:
+            return super().close()
+        self.released_at = time.monotonic()
+        _db_pool.append(self)
+
+    def discard(self):
+        super().close()
+
+def is_connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < DB_POOL_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    while _db_pool:
+        conn = _db_pool.pop()
+        if is_connection_alive(conn):
+            return conn
+        conn.discard()
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PooledConnection)
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def load_access_token_keys() -> dict:
+    '''Ключи подписи access-токенов из ACCESS_TOKEN_KEYS="kid:secret,kid2:secret2"'''
+    keys = {}
+    for entry in os.environ.get('ACCESS_TOKEN_KEYS', '').split(','):
+        key_id, _, secret = entry.strip().partition(':')
+        if key_id and secret:
+            keys[key_id] = secret.encode()
+    return keys
+
+ACCESS_TOKEN_KEYS = load_access_token_keys()
+
+def verify_access_token(token: str):
+    '''Проверяет подписанный access-токен без обращения к базе; возвращает id пользователя или None'''
+    try:
+        prefix, key_id, payload, signature = token.split('.')
+    except ValueError:
+        return None
+    key = ACCESS_TOKEN_KEYS.get(key_id)
+    if prefix != ACCESS_TOKEN_PREFIX or not key:
+        return None
+    
+    expected = hmac.new(key, f'{prefix}.{key_id}.{payload}'.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(base64.urlsafe_b64encode(expected).rstrip(b'='), signature.encode()):
+        return None
+    
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    if claims['exp'] <= time.time():
+        return None
+    return claims['uid']
+
+def authenticate(headers: dict):
+    '''Возвращает id пользователя по токену из X-Auth-Token.
+
+    Подписанные access-токены проверяются локально по HMAC. Если ACCESS_TOKEN_KEYS задан,
+    токены сессий (refresh) здесь не принимаются: их обменивает на access-токен только
+    auth?action=refresh. Без ключей токены сессий проверяются по базе.
+
+    Проверенные токены кэшируются в процессе (LRU + TTL), поэтому горячие пути опроса
+    не ходят в базу на каждый запрос; отзыв сессии виден не позже чем через SESSION_CACHE_TTL.
+    '''
+    token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+    if not token:
+        return None
+    if token.startswith(ACCESS_TOKEN_PREFIX + '.'):
+        return verify_access_token(token)
+    if ACCESS_TOKEN_KEYS:
+        return None
+    
+    token_hash = hash_token(token)
+    now = time.monotonic()
+    cached = _session_cache.get(token_hash)
+    if cached and cached[1] > now:
+        _session_cache.move_to_end(token_hash)
+        return cached[0]
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT user_id, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+        FROM sessions
+        WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > CURRENT_TIMESTAMP
+    """, (token_hash,))
+    session = cur.fetchone()
+    cur.close()
+    conn.close()
+    
+    if not session:
+        _session_cache.pop(token_hash, None)
+        return None
+    
+    _session_cache[token_hash] = (session[0], now + min(SESSION_CACHE_TTL, float(session[1])))
+    _session_cache.move_to_end(token_hash)
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+    return session[0]
+
+def notify_event(cur, event_type: str, chat_channel: str = None, **payload):
+    '''Публикует событие для push-сервиса; доставляется только после commit'''
+    data = json.dumps({'type': event_type, **payload})
+    cur.execute("SELECT pg_notify(%s, %s)", (PUSH_CHANNEL, data))
+    if chat_channel:
+        cur.execute("SELECT pg_notify(%s, %s)", (chat_channel, data))
+
+def listen_channel(conn, channel: str):
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'LISTEN "{channel}"')
+    conn.autocommit = False
+
+def wait_for_notify(conn, timeout: float) -> bool:
+    '''Блокирует запрос до NOTIFY по прослушиваемому каналу или до таймаута'''
+    conn.rollback()
+    # NOTIFY, пришедший во время последнего запроса или ROLLBACK, libpq уже прочитал из сокета
+    conn.poll()
+    if not conn.notifies and select.select([conn], [], [], max(timeout, 0)) == ([], [], []):
+        return False
+    conn.poll()
+    conn.notifies.clear()
+    return True
+
+def unlisten_all(conn):
+    conn.rollback()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('UNLISTEN *')
+    conn.autocommit = False
+
+def signal_version(signal_data):
+    '''Короткий тег signal_data: по нему long-poll замечает новый сигнал в активном звонке'''
+    return hashlib.sha1(signal_data.encode()).hexdigest()[:16] if signal_data else None
 
 def handler(event: dict, context) -> dict:
     '''API для WebRTC сигналинга звонков'''
@@ -16,7 +183,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -24,8 +191,7 @@ def handler(event: dict, context) -> dict:
         }
     
     try:
-        headers = event.get('headers', {})
-        user_id = headers.get('X-User-Id') or headers.get('x-user-id')
+        user_id = authenticate(event.get('headers', {}))
         
         if not user_id:
             return {
@@ -35,7 +201,6 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        user_id = int(user_id)
         conn = get_db_connection()
         cur = conn.cursor()
         
@@ -52,15 +217,38 @@ def handler(event: dict, context) -> dict:
                         'isBase64Encoded': False
                     }
                 
-                cur.execute("""
-                    SELECT id, caller_id, receiver_id, call_type, status, signal_data, created_at
-                    FROM call_sessions
-                    WHERE chat_id = %s AND status IN ('calling', 'ringing', 'active')
-                    ORDER BY created_at DESC
-                    LIMIT 1
-                """, (int(chat_id),))
+                known_call_id = event.get('queryStringParameters', {}).get('call_id')
+                known_status = event.get('queryStringParameters', {}).get('status')
+                known_signal = event.get('queryStringParameters', {}).get('signal')
+                wait = min(float(event.get('queryStringParameters', {}).get('wait') or 0), LONG_POLL_MAX_WAIT)
+                deadline = time.monotonic() + wait
+                if wait > 0:
+                    listen_channel(conn, CALL_CHANNEL.format(int(chat_id)))
+                
+                woken = False
+                while True:
+                    cur.execute("""
+                        SELECT id, caller_id, receiver_id, call_type, status, signal_data, created_at
+                        FROM call_sessions
+                        WHERE chat_id = %s AND status IN ('calling', 'ringing', 'active')
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                    """, (int(chat_id),))
+                    
+                    call = cur.fetchone()
+                    current_call_id = str(call[0]) if call else None
+                    current_status = call[4] if call else None
+                    current_signal = signal_version(call[5]) if call else None
+                    unchanged = (current_call_id, current_status, current_signal) == (known_call_id or None, known_status or None, known_signal or None)
+                    if woken or not unchanged or wait <= 0:
+                        break
+                    woken = wait_for_notify(conn, deadline - time.monotonic())
+                    if not woken:
+                        break
+                
+                if wait > 0:
+                    unlisten_all(conn)
                 
-                call = cur.fetchone()
                 cur.close()
                 conn.close()
                 
@@ -76,6 +264,7 @@ def handler(event: dict, context) -> dict:
                                 'call_type': call[3],
                                 'status': call[4],
                                 'signal_data': json.loads(call[5]) if call[5] else None,
+                                'signal_version': current_signal,
                                 'created_at': call[6].isoformat()
                             }
                         }),
@@ -113,6 +302,7 @@ def handler(event: dict, context) -> dict:
                 """, (chat_id, user_id, receiver_id, call_type))
                 
                 call_id = cur.fetchone()[0]
+                notify_event(cur, 'call', chat_channel=CALL_CHANNEL.format(int(chat_id)), call_id=call_id, chat_id=int(chat_id), caller_id=user_id, receiver_id=int(receiver_id), status='calling')
                 conn.commit()
                 cur.close()
                 conn.close()
@@ -140,8 +330,12 @@ def handler(event: dict, context) -> dict:
                     UPDATE call_sessions 
                     SET signal_data = %s, status = 'active'
                     WHERE id = %s
+                    RETURNING chat_id, caller_id, receiver_id
                 """, (json.dumps(signal_data), call_id))
                 
+                call = cur.fetchone()
+                if call:
+                    notify_event(cur, 'call', chat_channel=CALL_CHANNEL.format(call[0]), call_id=int(call_id), chat_id=call[0], caller_id=call[1], receiver_id=call[2], status='active')
                 conn.commit()
                 cur.close()
                 conn.close()
@@ -168,8 +362,12 @@ def handler(event: dict, context) -> dict:
                     UPDATE call_sessions 
                     SET status = 'ended', ended_at = CURRENT_TIMESTAMP
                     WHERE id = %s
+                    RETURNING chat_id, caller_id, receiver_id
                 """, (call_id,))
                 
+                call = cur.fetchone()
+                if call:
+                    notify_event(cur, 'call', chat_channel=CALL_CHANNEL.format(call[0]), call_id=int(call_id), chat_id=call[0], caller_id=call[1], receiver_id=call[2], status='ended')
                 conn.commit()
                 cur.close()
                 conn.close()
@@ -0,0 +1,3 @@
+-- Составные индексы для курсорной пагинации и синхронизации сообщений
+CREATE INDEX idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX idx_messages_chat_id_created_at ON messages(chat_id, created_at);
\ No newline at end of file
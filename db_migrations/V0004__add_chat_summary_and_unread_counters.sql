@@ -0,0 +1,29 @@
+-- Денормализованная сводка последнего сообщения чата
+ALTER TABLE chats ADD COLUMN last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN last_message_text TEXT;
+ALTER TABLE chats ADD COLUMN last_message_time TIMESTAMP;
+
+-- Счётчик непрочитанных сообщений для каждого участника чата
+ALTER TABLE chat_members ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0;
+
+-- Заполняем сводку по уже существующим сообщениям
+UPDATE chats c
+SET last_message_id = m.id,
+    last_message_text = m.message_text,
+    last_message_time = m.created_at
+FROM (
+    SELECT DISTINCT ON (chat_id) id, chat_id, message_text, created_at
+    FROM messages
+    ORDER BY chat_id, id DESC
+) m
+WHERE m.chat_id = c.id;
+
+UPDATE chat_members cm
+SET unread_count = s.unread_count
+FROM (
+    SELECT cm2.id, COUNT(m.id) AS unread_count
+    FROM chat_members cm2
+    INNER JOIN messages m ON m.chat_id = cm2.chat_id AND m.sender_id != cm2.user_id AND m.is_read = false
+    GROUP BY cm2.id
+) s
+WHERE s.id = cm.id;
\ No newline at end of file
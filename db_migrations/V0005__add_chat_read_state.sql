@@ -0,0 +1,21 @@
+-- Курсор прочтения: последнее прочитанное сообщение для каждого участника чата
+CREATE TABLE chat_read_state (
+    chat_id INTEGER REFERENCES chats(id),
+    user_id INTEGER REFERENCES users(id),
+    last_read_message_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+
+-- Переносим состояние прочтения из флагов is_read
+INSERT INTO chat_read_state (chat_id, user_id, last_read_message_id)
+SELECT cm.chat_id, cm.user_id, COALESCE(
+    (SELECT MIN(m.id) - 1 FROM messages m
+     WHERE m.chat_id = cm.chat_id AND m.sender_id != cm.user_id AND m.is_read = false),
+    (SELECT MAX(m.id) FROM messages m WHERE m.chat_id = cm.chat_id),
+    0
+)
+FROM chat_members cm;
+
+-- Непрочитанные теперь считаются по курсору, счётчик больше не нужен
+ALTER TABLE chat_members DROP COLUMN unread_count;
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Полнотекстовый поиск по сообщениям: русская морфология + простая конфигурация
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+    to_tsvector('russian', coalesce(message_text, '')) || to_tsvector('simple', coalesce(message_text, ''))
+) STORED;
+
+CREATE INDEX idx_messages_search_vector ON messages USING GIN (search_vector);
+
+-- Триграммный индекс для поиска по подстроке
+CREATE INDEX idx_messages_message_text_trgm ON messages USING GIN (message_text gin_trgm_ops);
\ No newline at end of file
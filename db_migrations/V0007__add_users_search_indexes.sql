@@ -0,0 +1,8 @@
+-- Индексы для поиска пользователей: префиксный поиск по B-tree и поиск по подстроке через триграммы
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX idx_users_username_prefix ON users (lower(username) text_pattern_ops);
+CREATE INDEX idx_users_nickname_prefix ON users (lower(nickname) text_pattern_ops);
+
+CREATE INDEX idx_users_username_trgm ON users USING GIN (username gin_trgm_ops);
+CREATE INDEX idx_users_nickname_trgm ON users USING GIN (nickname gin_trgm_ops);
\ No newline at end of file
@@ -0,0 +1,12 @@
+-- Метаданные загруженных файлов
+CREATE TABLE files (
+    id SERIAL PRIMARY KEY,
+    object_key TEXT UNIQUE NOT NULL,
+    user_id INTEGER REFERENCES users(id),
+    file_name VARCHAR(255),
+    file_type VARCHAR(100),
+    file_size BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_files_user_id ON files(user_id);
\ No newline at end of file
@@ -0,0 +1,5 @@
+-- Дедупликация файлов по содержимому: SHA-256 и счётчик ссылок
+ALTER TABLE files ADD COLUMN sha256 CHAR(64);
+ALTER TABLE files ADD COLUMN ref_count INTEGER NOT NULL DEFAULT 1;
+
+CREATE UNIQUE INDEX idx_files_sha256 ON files(sha256);
\ No newline at end of file
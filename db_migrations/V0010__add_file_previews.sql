@@ -0,0 +1,7 @@
+-- Миниатюры изображений и LQIP-плейсхолдер
+ALTER TABLE files ADD COLUMN thumbnails JSONB;
+ALTER TABLE files ADD COLUMN placeholder TEXT;
+
+-- Превью хранится вместе с сообщением, чтобы лента не делала лишних JOIN
+ALTER TABLE messages ADD COLUMN file_id INTEGER REFERENCES files(id);
+ALTER TABLE messages ADD COLUMN file_preview JSONB;
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Сессии: храним только SHA-256 от токена
+CREATE TABLE sessions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    token_hash CHAR(64) UNIQUE NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP
+);
+
+CREATE INDEX idx_sessions_user_id ON sessions(user_id);
\ No newline at end of file
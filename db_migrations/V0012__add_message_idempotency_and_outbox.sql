@@ -0,0 +1,14 @@
+-- Клиентский id сообщения: повторная отправка после таймаута не создаёт дубликат
+ALTER TABLE messages ADD COLUMN client_msg_id UUID;
+
+CREATE UNIQUE INDEX idx_messages_client_msg_id ON messages(chat_id, sender_id, client_msg_id);
+
+-- Outbox: события пишутся в той же транзакции, что и сообщения, и читаются push-сервисом
+CREATE TABLE outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event_type VARCHAR(32) NOT NULL,
+    payload JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_outbox_created_at ON outbox(created_at);
\ No newline at end of file
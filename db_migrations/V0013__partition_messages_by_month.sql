@@ -0,0 +1,99 @@
+-- Помесячное секционирование сообщений по created_at
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    chat_id INTEGER REFERENCES chats(id),
+    sender_id INTEGER REFERENCES users(id),
+    message_text TEXT,
+    message_type VARCHAR(20) DEFAULT 'text',
+    file_url TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('russian', coalesce(message_text, '')) || to_tsvector('simple', coalesce(message_text, ''))
+    ) STORED,
+    file_id INTEGER REFERENCES files(id),
+    file_preview JSONB,
+    client_msg_id UUID,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Страховка на случай, если секцию на новый месяц не успели создать
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+CREATE FUNCTION create_messages_partition(month DATE) RETURNS BOOLEAN AS $$
+DECLARE
+    partition_name TEXT := 'messages_' || to_char(month, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name, date_trunc('month', month), date_trunc('month', month) + INTERVAL '1 month'
+    );
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Создаёт секции на текущий и следующие месяцы; возвращает число новых секций
+CREATE FUNCTION ensure_messages_partitions(months_ahead INTEGER) RETURNS INTEGER AS $$
+    SELECT COUNT(*)::INTEGER FROM generate_series(0, months_ahead) AS shift
+    WHERE create_messages_partition((date_trunc('month', CURRENT_TIMESTAMP) + shift * INTERVAL '1 month')::date);
+$$ LANGUAGE sql;
+
+SELECT create_messages_partition(month::date)
+FROM generate_series(
+    date_trunc('month', COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), CURRENT_TIMESTAMP)),
+    date_trunc('month', CURRENT_TIMESTAMP),
+    INTERVAL '1 month'
+) AS month;
+
+SELECT ensure_messages_partitions(3);
+
+INSERT INTO messages (id, chat_id, sender_id, message_text, message_type, file_url, created_at, file_id, file_preview, client_msg_id)
+SELECT id, chat_id, sender_id, message_text, message_type, file_url, COALESCE(created_at, CURRENT_TIMESTAMP), file_id, file_preview, client_msg_id
+FROM messages_unpartitioned;
+
+-- Ключи идемпотентности: уникальный индекс на секционированной таблице обязан включать created_at,
+-- поэтому (chat_id, sender_id, client_msg_id) живут в отдельной таблице
+CREATE TABLE message_client_ids (
+    chat_id INTEGER NOT NULL,
+    sender_id INTEGER NOT NULL,
+    client_msg_id UUID NOT NULL,
+    message_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, sender_id, client_msg_id)
+);
+
+CREATE INDEX idx_message_client_ids_created_at ON message_client_ids(created_at);
+
+INSERT INTO message_client_ids (chat_id, sender_id, client_msg_id, message_id, created_at)
+SELECT chat_id, sender_id, client_msg_id, id, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM messages_unpartitioned
+WHERE client_msg_id IS NOT NULL;
+
+DROP TABLE messages_unpartitioned;
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Локальные индексы секций; глобальный индекс по created_at заменён секционированием
+CREATE INDEX idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX idx_messages_chat_id_created_at ON messages(chat_id, created_at);
+CREATE INDEX idx_messages_search_vector ON messages USING GIN (search_vector);
+CREATE INDEX idx_messages_message_text_trgm ON messages USING GIN (message_text gin_trgm_ops);
+
+-- Выгруженные в объектное хранилище холодные секции: по объекту на чат и месяц
+CREATE TABLE message_archives (
+    chat_id INTEGER NOT NULL,
+    month DATE NOT NULL,
+    object_key TEXT NOT NULL,
+    min_id INTEGER NOT NULL,
+    max_id INTEGER NOT NULL,
+    message_count INTEGER NOT NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, month)
+);
+
+CREATE INDEX idx_message_archives_chat_id_max_id ON message_archives(chat_id, max_id);
\ No newline at end of file
@@ -0,0 +1,37 @@
+-- Если строки месяца уже попали в секцию по умолчанию, CREATE TABLE ... PARTITION OF для этого месяца
+-- падает; теперь такие строки переносятся в новую секцию в той же транзакции
+CREATE OR REPLACE FUNCTION create_messages_partition(month DATE) RETURNS BOOLEAN AS $$
+DECLARE
+    partition_name TEXT := 'messages_' || to_char(month, 'YYYY_MM');
+    month_start TIMESTAMP := date_trunc('month', month);
+    month_end TIMESTAMP := date_trunc('month', month) + INTERVAL '1 month';
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+
+    -- Блокируем вставки, чтобы между проверкой и созданием секции в messages_default не появились новые строки месяца
+    LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE;
+
+    IF NOT EXISTS (SELECT 1 FROM messages_default WHERE created_at >= month_start AND created_at < month_end) THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)', partition_name, month_start, month_end);
+        RETURN true;
+    END IF;
+
+    ALTER TABLE messages DETACH PARTITION messages_default;
+    EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)', partition_name, month_start, month_end);
+    INSERT INTO messages (id, chat_id, sender_id, message_text, message_type, file_url, created_at, file_id, file_preview, client_msg_id)
+    SELECT id, chat_id, sender_id, message_text, message_type, file_url, created_at, file_id, file_preview, client_msg_id
+    FROM messages_default
+    WHERE created_at >= month_start AND created_at < month_end;
+    DELETE FROM messages_default WHERE created_at >= month_start AND created_at < month_end;
+    ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT;
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Переносит строки, которые уже лежат в секции по умолчанию
+SELECT create_messages_partition(month::date)
+FROM (
+    SELECT DISTINCT date_trunc('month', created_at) AS month FROM messages_default
+) AS default_months;
\ No newline at end of file
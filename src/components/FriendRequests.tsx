@@ -3,7 +3,7 @@ import { Button } from './ui/button';
 import { Avatar, AvatarFallback, AvatarImage } from './ui/avatar';
 import { ScrollArea } from './ui/scroll-area';
 import Icon from './ui/icon';
-import { api } from '@/lib/api';
+import { api, push } from '@/lib/api';
 import { useToast } from '@/hooks/use-toast';
 
 type FriendRequest = {
@@ -26,8 +26,16 @@ export const FriendRequests = ({ userId, onRequestAccepted }: FriendRequestsProp
 
   useEffect(() => {
     loadRequests();
-    const interval = setInterval(loadRequests, 5000);
-    return () => clearInterval(interval);
+    const interval = setInterval(loadRequests, push.isAvailable() ? 60000 : 5000);
+    const unsubscribe = push.subscribe(userId, (event) => {
+      if (event.type === 'friend_request') {
+        loadRequests();
+      }
+    });
+    return () => {
+      clearInterval(interval);
+      unsubscribe();
+    };
   }, [userId]);
 
   const loadRequests = async () => {
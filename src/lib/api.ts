@@ -6,6 +6,135 @@ const API_ENDPOINTS = {
   webrtc: 'https://functions.poehali.dev/398b444b-258c-44c7-ad38-a15bfba1874e',
 };
 
+const authHeaders = (): Record<string, string> => ({
+  'X-Auth-Token': localStorage.getItem('moonly_token') || ''
+});
+
+const SESSION_KEYS = ['moonly_user', 'moonly_token', 'moonly_refresh_token'];
+const sessionExpiredListeners = new Set<() => void>();
+
+const expireSession = () => {
+  session.clear();
+  sessionExpiredListeners.forEach(l => l());
+};
+
+let refreshing: Promise<boolean> | null = null;
+
+const refreshAccessToken = () => {
+  const refreshToken = localStorage.getItem('moonly_refresh_token');
+  if (!refreshToken) {
+    if (localStorage.getItem('moonly_token')) expireSession();
+    return Promise.resolve(false);
+  }
+  if (!refreshing) {
+    refreshing = fetch(API_ENDPOINTS.auth, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'refresh', refresh_token: refreshToken })
+    })
+      .then(r => {
+        if (r.status === 401) {
+          expireSession();
+          return {};
+        }
+        return r.json();
+      })
+      .then(data => {
+        if (!data.token) return false;
+        localStorage.setItem('moonly_token', data.token);
+        return true;
+      })
+      .catch(() => false)
+      .finally(() => { refreshing = null; });
+  }
+  return refreshing;
+};
+
+const authFetch = async (url: string, init: RequestInit = {}) => {
+  const send = () => fetch(url, { ...init, headers: { ...(init.headers as Record<string, string>), ...authHeaders() } });
+  const response = await send();
+  if (response.status === 401 && await refreshAccessToken()) {
+    return send();
+  }
+  return response;
+};
+
+const HASH_BEFORE_UPLOAD_LIMIT = 64 * 1024 * 1024;
+const SEND_MESSAGE_ATTEMPTS = 3;
+
+const sha256Hex = async (file: Blob) => {
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
+const PUSH_URL = import.meta.env.VITE_PUSH_URL as string | undefined;
+
+export type PushEvent = {
+  type: 'message' | 'read' | 'friend_request' | 'call' | 'typing';
+  chat_id?: number;
+  [key: string]: unknown;
+};
+
+type PushListener = (event: PushEvent) => void;
+
+const pushListeners = new Set<PushListener>();
+let pushSource: EventSource | null = null;
+
+const openPushSource = () => {
+  const source = new EventSource(`${PUSH_URL}/events?token=${encodeURIComponent(localStorage.getItem('moonly_token') || '')}`);
+  pushSource = source;
+  (['message', 'read', 'friend_request', 'call', 'typing'] as const).forEach(type => {
+    source.addEventListener(type, (e) => {
+      const event = JSON.parse((e as MessageEvent).data) as PushEvent;
+      pushListeners.forEach(l => l(event));
+    });
+  });
+  source.onerror = () => {
+    if (source.readyState !== EventSource.CLOSED) return;
+    refreshAccessToken().then(ok => {
+      if (ok && pushSource === source && pushListeners.size > 0) {
+        openPushSource();
+      }
+    });
+  };
+};
+
+export const push = {
+  isAvailable() {
+    return Boolean(PUSH_URL);
+  },
+
+  subscribe(userId: number, listener: PushListener) {
+    if (!PUSH_URL) return () => {};
+    pushListeners.add(listener);
+    if (!pushSource) {
+      openPushSource();
+    }
+    return () => {
+      pushListeners.delete(listener);
+      if (pushListeners.size === 0) {
+        pushSource?.close();
+        pushSource = null;
+      }
+    };
+  }
+};
+
+export const session = {
+  clear() {
+    SESSION_KEYS.forEach(key => localStorage.removeItem(key));
+    pushSource?.close();
+    pushSource = null;
+  },
+
+  onExpired(listener: () => void) {
+    sessionExpiredListeners.add(listener);
+    return () => {
+      sessionExpiredListeners.delete(listener);
+    };
+  }
+};
+
 export const api = {
   async register(username: string, nickname: string, email: string, password: string) {
     const response = await fetch(API_ENDPOINTS.auth, {
@@ -25,51 +154,89 @@ export const api = {
     return response.json();
   },
 
-  async getChats(userId: number) {
-    const response = await fetch(`${API_ENDPOINTS.messages}?action=chats`, {
-      headers: { 'X-User-Id': userId.toString() }
+  async logout() {
+    const response = await fetch(API_ENDPOINTS.auth, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'logout', refresh_token: localStorage.getItem('moonly_refresh_token') })
     });
     return response.json();
   },
 
-  async getMessages(userId: number, chatId: number, search?: string) {
-    const url = search 
-      ? `${API_ENDPOINTS.messages}?action=messages&chat_id=${chatId}&search=${encodeURIComponent(search)}`
-      : `${API_ENDPOINTS.messages}?action=messages&chat_id=${chatId}`;
-    const response = await fetch(url, {
-      headers: { 'X-User-Id': userId.toString() }
-    });
+  async getChats(userId: number) {
+    const response = await authFetch(`${API_ENDPOINTS.messages}?action=chats`);
+    return response.json();
+  },
+
+  async getMessages(userId: number, chatId: number, search?: string, afterId?: number, wait?: number) {
+    let url = `${API_ENDPOINTS.messages}?action=messages&chat_id=${chatId}`;
+    if (search) {
+      url += `&search=${encodeURIComponent(search)}`;
+    } else if (afterId !== undefined) {
+      url += `&after_id=${afterId}`;
+      if (wait) {
+        url += `&wait=${wait}`;
+      }
+    }
+    const response = await authFetch(url);
+    return response.json();
+  },
+
+  async searchMessages(userId: number, query: string) {
+    const response = await authFetch(`${API_ENDPOINTS.messages}?action=search&query=${encodeURIComponent(query)}`);
     return response.json();
   },
 
-  async sendMessage(userId: number, chatId: number, messageText: string, messageType = 'text', fileUrl?: string) {
-    const response = await fetch(API_ENDPOINTS.messages, {
+  async getMessagesPage(userId: number, chatId: number, beforeId?: number, limit = 50) {
+    let url = `${API_ENDPOINTS.messages}?action=messages&chat_id=${chatId}&limit=${limit}`;
+    if (beforeId) {
+      url += `&before_id=${beforeId}`;
+    }
+    const response = await authFetch(url);
+    return response.json();
+  },
+
+  async sendMessage(userId: number, chatId: number, messageText: string, messageType = 'text', fileUrl?: string, fileId?: number) {
+    const clientMsgId = crypto.randomUUID();
+    for (let attempt = 1; ; attempt++) {
+      try {
+        const response = await authFetch(API_ENDPOINTS.messages, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ action: 'send_message', chat_id: chatId, message_text: messageText, message_type: messageType, file_url: fileUrl, file_id: fileId, client_msg_id: clientMsgId })
+        });
+        return response.json();
+      } catch (error) {
+        if (attempt >= SEND_MESSAGE_ATTEMPTS) throw error;
+        await new Promise(resolve => setTimeout(resolve, attempt * 1000));
+      }
+    }
+  },
+
+  async sendMessages(userId: number, chatId: number, messages: { client_msg_id: string; message_text: string; message_type?: string; file_url?: string; file_id?: number }[]) {
+    const response = await authFetch(API_ENDPOINTS.messages, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
-      body: JSON.stringify({ action: 'send_message', chat_id: chatId, message_text: messageText, message_type: messageType, file_url: fileUrl })
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'send_messages', chat_id: chatId, messages })
     });
     return response.json();
   },
 
   async createChat(userId: number, otherUserId?: number, isGroup = false, groupName?: string) {
-    const response = await fetch(API_ENDPOINTS.messages, {
+    const response = await authFetch(API_ENDPOINTS.messages, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'create_chat', other_user_id: otherUserId, is_group: isGroup, group_name: groupName })
     });
     return response.json();
   },
 
-  async searchUsers(userId: number, query: string) {
-    const response = await fetch(`${API_ENDPOINTS.users}?action=search&query=${encodeURIComponent(query)}`, {
-      headers: { 'X-User-Id': userId.toString() }
-    });
+  async searchUsers(userId: number, query: string, cursor?: string) {
+    let url = `${API_ENDPOINTS.users}?action=search&query=${encodeURIComponent(query)}`;
+    if (cursor) {
+      url += `&cursor=${encodeURIComponent(cursor)}`;
+    }
+    const response = await authFetch(url);
     return response.json();
   },
 
@@ -77,131 +244,167 @@ export const api = {
     const url = profileUserId 
       ? `${API_ENDPOINTS.users}?action=profile&user_id=${profileUserId}`
       : `${API_ENDPOINTS.users}?action=profile`;
-    const response = await fetch(url, {
-      headers: { 'X-User-Id': userId.toString() }
+    const response = await authFetch(url);
+    return response.json();
+  },
+
+  async heartbeat(userId: number) {
+    const response = await authFetch(API_ENDPOINTS.users, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'heartbeat' })
     });
     return response.json();
   },
 
   async updateProfile(userId: number, data: { nickname?: string; avatar_url?: string; status_text?: string; status_emoji?: string }) {
-    const response = await fetch(API_ENDPOINTS.users, {
+    const response = await authFetch(API_ENDPOINTS.users, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'update_profile', ...data })
     });
     return response.json();
   },
 
   async sendFriendRequest(userId: number, username: string) {
-    const response = await fetch(API_ENDPOINTS.users, {
+    const response = await authFetch(API_ENDPOINTS.users, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'send_friend_request', username })
     });
     return response.json();
   },
 
   async getFriendRequests(userId: number) {
-    const response = await fetch(`${API_ENDPOINTS.users}?action=friend_requests`, {
-      headers: { 'X-User-Id': userId.toString() }
-    });
+    const response = await authFetch(`${API_ENDPOINTS.users}?action=friend_requests`);
     return response.json();
   },
 
   async acceptFriendRequest(userId: number, requestId: number) {
-    const response = await fetch(API_ENDPOINTS.users, {
+    const response = await authFetch(API_ENDPOINTS.users, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'accept_friend_request', request_id: requestId })
     });
     return response.json();
   },
 
   async rejectFriendRequest(userId: number, requestId: number) {
-    const response = await fetch(API_ENDPOINTS.users, {
+    const response = await authFetch(API_ENDPOINTS.users, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'reject_friend_request', request_id: requestId })
     });
     return response.json();
   },
 
+  async sendTyping(userId: number, chatId: number) {
+    const response = await authFetch(API_ENDPOINTS.messages, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'typing', chat_id: chatId })
+    });
+    return response.json();
+  },
+
   async muteChat(userId: number, chatId: number, isMuted: boolean) {
-    const response = await fetch(API_ENDPOINTS.messages, {
+    const response = await authFetch(API_ENDPOINTS.messages, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'mute_chat', chat_id: chatId, is_muted: isMuted })
     });
     return response.json();
   },
 
   async uploadFile(userId: number, fileData: string, fileName: string, fileType: string) {
-    const response = await fetch(API_ENDPOINTS.files, {
+    const response = await authFetch(API_ENDPOINTS.files, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ file_data: fileData, file_name: fileName, file_type: fileType })
     });
     return response.json();
   },
 
+  async uploadFileDirect(userId: number, file: File) {
+    const headers = { 'Content-Type': 'application/json' };
+    const fileType = file.type || 'application/octet-stream';
+    const sha256 = file.size <= HASH_BEFORE_UPLOAD_LIMIT ? await sha256Hex(file) : undefined;
+    const session = await authFetch(API_ENDPOINTS.files, {
+      method: 'POST',
+      headers,
+      body: JSON.stringify({ action: 'create_upload', file_name: file.name, file_type: fileType, file_size: file.size, sha256 })
+    }).then(r => r.json());
+    if (!session.success || session.deduplicated) return session;
+
+    const uploads = session.upload_url
+      ? [fetch(session.upload_url, { method: 'PUT', headers: { 'Content-Type': fileType }, body: file })]
+      : session.part_urls.map((url: string, index: number) =>
+          fetch(url, { method: 'PUT', body: file.slice(index * session.part_size, (index + 1) * session.part_size) }));
+    const results = await Promise.all(uploads);
+    if (results.some((result: Response) => !result.ok)) {
+      if (session.upload_id) {
+        await authFetch(API_ENDPOINTS.files, {
+          method: 'POST',
+          headers,
+          body: JSON.stringify({ action: 'abort_upload', object_key: session.object_key, upload_id: session.upload_id })
+        }).catch(() => {});
+      }
+      throw new Error('Upload failed');
+    }
+
+    const response = await authFetch(API_ENDPOINTS.files, {
+      method: 'POST',
+      headers,
+      body: JSON.stringify({
+        action: 'complete_upload',
+        object_key: session.object_key,
+        upload_id: session.upload_id,
+        file_name: file.name,
+        file_type: fileType
+      })
+    });
+    return response.json();
+  },
+
   async startCall(userId: number, chatId: number, receiverId: number, callType: 'audio' | 'video') {
-    const response = await fetch(API_ENDPOINTS.webrtc, {
+    const response = await authFetch(API_ENDPOINTS.webrtc, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'start_call', chat_id: chatId, receiver_id: receiverId, call_type: callType })
     });
     return response.json();
   },
 
   async updateCallSignal(userId: number, callId: number, signalData: any) {
-    const response = await fetch(API_ENDPOINTS.webrtc, {
+    const response = await authFetch(API_ENDPOINTS.webrtc, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'update_signal', call_id: callId, signal_data: signalData })
     });
     return response.json();
   },
 
   async endCall(userId: number, callId: number) {
-    const response = await fetch(API_ENDPOINTS.webrtc, {
+    const response = await authFetch(API_ENDPOINTS.webrtc, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'X-User-Id': userId.toString()
-      },
+      headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'end_call', call_id: callId })
     });
     return response.json();
   },
 
-  async pollCall(userId: number, chatId: number) {
-    const response = await fetch(`${API_ENDPOINTS.webrtc}?action=poll&chat_id=${chatId}`, {
-      headers: { 'X-User-Id': userId.toString() }
-    });
+  async pollCall(userId: number, chatId: number, known?: { callId: number; status: string; signalVersion?: string | null }, wait?: number) {
+    let url = `${API_ENDPOINTS.webrtc}?action=poll&chat_id=${chatId}`;
+    if (known) {
+      url += `&call_id=${known.callId}&status=${known.status}`;
+      if (known.signalVersion) {
+        url += `&signal=${known.signalVersion}`;
+      }
+    }
+    if (wait) {
+      url += `&wait=${wait}`;
+    }
+    const response = await authFetch(url);
     return response.json();
   }
 };
\ No newline at end of file
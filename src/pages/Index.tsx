@@ -8,7 +8,7 @@ import { Label } from '@/components/ui/label';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs';
 import { Badge } from '@/components/ui/badge';
 import Icon from '@/components/ui/icon';
-import { api } from '@/lib/api';
+import { api, push, session } from '@/lib/api';
 import { useToast } from '@/hooks/use-toast';
 import { WebRTCCall } from '@/components/WebRTCCall';
 import { FriendRequests } from '@/components/FriendRequests';
@@ -43,14 +43,26 @@ type Message = {
   text: string;
   type: string;
   file_url?: string;
+  preview?: { thumbnails: Record<string, string>; placeholder: string } | null;
   time: string;
+  sender_id: number;
   is_own: boolean;
   sender_name: string;
 };
 
+const LONG_POLL_WAIT = 25;
+const HEARTBEAT_INTERVAL = 30000;
+const TYPING_SEND_INTERVAL = 3000;
+const TYPING_TTL = 6;
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+
 const Index = () => {
   const { toast } = useToast();
   const fileInputRef = useRef<HTMLInputElement>(null);
+  const messagesCursorRef = useRef<{ chatId: number; cursor: number } | null>(null);
+  const typingTimersRef = useRef<Record<number, number>>({});
+  const typingSentAtRef = useRef(0);
   const [currentUser, setCurrentUser] = useState<User | null>(null);
   const [isAuthenticated, setIsAuthenticated] = useState(false);
   const [authMode, setAuthMode] = useState<'login' | 'register'>('login');
@@ -62,8 +74,12 @@ const Index = () => {
   
   const [chats, setChats] = useState<Chat[]>([]);
   const [selectedChat, setSelectedChat] = useState<Chat | null>(null);
+  const chatsRef = useRef<Chat[]>([]);
+  chatsRef.current = chats;
   const [messages, setMessages] = useState<Message[]>([]);
+  const [olderMessagesCursor, setOlderMessagesCursor] = useState<number | null>(null);
   const [messageText, setMessageText] = useState('');
+  const [typingUserIds, setTypingUserIds] = useState<number[]>([]);
   const [searchText, setSearchText] = useState('');
   
   const [addFriendNick, setAddFriendNick] = useState('');
@@ -87,24 +103,97 @@ const Index = () => {
       setCurrentUser(JSON.parse(savedUser));
       setIsAuthenticated(true);
     }
+    return session.onExpired(() => {
+      resetSession();
+      toast({ title: 'Сессия истекла', description: 'Войдите снова', variant: 'destructive' });
+    });
   }, []);
 
   useEffect(() => {
     if (isAuthenticated && currentUser) {
       loadChats();
-      const interval = setInterval(loadChats, 5000);
+      const interval = setInterval(loadChats, push.isAvailable() ? 60000 : 5000);
       return () => clearInterval(interval);
     }
   }, [isAuthenticated, currentUser]);
 
+  useEffect(() => {
+    if (isAuthenticated && currentUser) {
+      const sendHeartbeat = () => {
+        if (document.visibilityState === 'visible') {
+          api.heartbeat(currentUser.id).catch(() => {});
+        }
+      };
+      sendHeartbeat();
+      const interval = setInterval(sendHeartbeat, HEARTBEAT_INTERVAL);
+      document.addEventListener('visibilitychange', sendHeartbeat);
+      return () => {
+        clearInterval(interval);
+        document.removeEventListener('visibilitychange', sendHeartbeat);
+      };
+    }
+  }, [isAuthenticated, currentUser]);
+
   useEffect(() => {
     if (selectedChat && currentUser) {
-      loadMessages(selectedChat.id);
-      const interval = setInterval(() => loadMessages(selectedChat.id), 3000);
-      return () => clearInterval(interval);
+      messagesCursorRef.current = null;
+      setOlderMessagesCursor(null);
+      setTypingUserIds([]);
+      const chatId = selectedChat.id;
+      let active = true;
+      const pollMessages = async () => {
+        await loadMessages(chatId);
+        while (active) {
+          if (push.isAvailable()) {
+            await sleep(30000);
+            if (active) await syncMessages(chatId);
+          } else if (!(await syncMessages(chatId, LONG_POLL_WAIT))) {
+            await sleep(3000);
+          }
+        }
+      };
+      pollMessages();
+      const unsubscribe = push.subscribe(currentUser.id, (event) => {
+        if (event.type === 'message' && event.chat_id === chatId) {
+          syncMessages(chatId);
+        } else if (event.type === 'typing' && event.chat_id === chatId) {
+          markTyping([event.user_id as number], event.ttl as number);
+        }
+      });
+      return () => {
+        active = false;
+        unsubscribe();
+      };
     }
   }, [selectedChat, currentUser]);
 
+  useEffect(() => {
+    if (isAuthenticated && currentUser) {
+      return push.subscribe(currentUser.id, (event) => {
+        if (event.type === 'message') {
+          if (!chatsRef.current.some(chat => chat.id === event.chat_id)) {
+            loadChats();
+            return;
+          }
+          const received = event.sender_id === currentUser.id ? 0 : Array.isArray(event.message_ids) ? event.message_ids.length : 1;
+          setChats(prev => {
+            const chat = prev.find(c => c.id === event.chat_id);
+            if (!chat) return prev;
+            const updated = {
+              ...chat,
+              last_message: event.text as string,
+              last_message_time: event.created_at as string,
+              unread_count: chat.unread_count + received
+            };
+            return [updated, ...prev.filter(c => c.id !== chat.id)];
+          });
+        } else if (event.type === 'read' && event.user_id === currentUser.id) {
+          loadChats();
+        }
+      });
+    }
+  }, [isAuthenticated, currentUser]);
+
   const loadChats = async () => {
     if (!currentUser) return;
     try {
@@ -120,15 +209,82 @@ const Index = () => {
   const loadMessages = async (chatId: number, search?: string) => {
     if (!currentUser) return;
     try {
-      const response = await api.getMessages(currentUser.id, chatId, search);
+      const response = search
+        ? await api.getMessages(currentUser.id, chatId, search)
+        : await api.getMessagesPage(currentUser.id, chatId);
       if (response.messages) {
         setMessages(response.messages);
+        setOlderMessagesCursor(!search && response.has_more ? response.before_id : null);
+        messagesCursorRef.current = search ? null : { chatId, cursor: response.cursor };
       }
     } catch (error) {
       console.error('Failed to load messages:', error);
     }
   };
 
+  const loadOlderMessages = async () => {
+    if (!currentUser || !selectedChat || !olderMessagesCursor) return;
+    try {
+      const response = await api.getMessagesPage(currentUser.id, selectedChat.id, olderMessagesCursor);
+      if (response.messages) {
+        setMessages(prev => [...response.messages, ...prev]);
+        setOlderMessagesCursor(response.has_more ? response.before_id : null);
+      }
+    } catch (error) {
+      console.error('Failed to load older messages:', error);
+    }
+  };
+
+  const markTyping = (userIds: number[], ttl = TYPING_TTL) => {
+    const ids = userIds.filter(id => id !== currentUser?.id);
+    if (ids.length === 0) return;
+    setTypingUserIds(prev => Array.from(new Set([...prev, ...ids])));
+    ids.forEach(id => {
+      clearTimeout(typingTimersRef.current[id]);
+      typingTimersRef.current[id] = window.setTimeout(() => {
+        setTypingUserIds(prev => prev.filter(typingId => typingId !== id));
+      }, ttl * 1000);
+    });
+  };
+
+  const handleMessageTextChange = (value: string) => {
+    setMessageText(value);
+    if (!value || !selectedChat || !currentUser) return;
+    const now = Date.now();
+    if (now - typingSentAtRef.current < TYPING_SEND_INTERVAL) return;
+    typingSentAtRef.current = now;
+    api.sendTyping(currentUser.id, selectedChat.id).catch(() => {});
+  };
+
+  const syncMessages = async (chatId: number, wait?: number) => {
+    if (!currentUser) return false;
+    const state = messagesCursorRef.current;
+    if (!state || state.chatId !== chatId) return false;
+    try {
+      const response = await api.getMessages(currentUser.id, chatId, undefined, state.cursor, wait);
+      if (!response.messages) return false;
+      if (messagesCursorRef.current !== state) return true;
+      if (response.typing) markTyping(response.typing);
+      if (response.unchanged || response.messages.length === 0) return false;
+      messagesCursorRef.current = { chatId, cursor: response.cursor };
+      setMessages(prev => [...prev, ...response.messages]);
+      const senderIds = response.messages.map((m: Message) => m.sender_id);
+      setTypingUserIds(prev => prev.filter(id => !senderIds.includes(id)));
+      return true;
+    } catch (error) {
+      console.error('Failed to sync messages:', error);
+      return false;
+    }
+  };
+
+  const resetSession = () => {
+    setIsAuthenticated(false);
+    setCurrentUser(null);
+    setSelectedChat(null);
+    setChats([]);
+    setMessages([]);
+  };
+
   const handleAuth = async () => {
     try {
       let response;
@@ -154,6 +310,7 @@ const Index = () => {
       if (response.success && response.user) {
         localStorage.setItem('moonly_user', JSON.stringify(response.user));
         localStorage.setItem('moonly_token', response.token);
+        localStorage.setItem('moonly_refresh_token', response.refresh_token);
         setCurrentUser(response.user);
         setIsAuthenticated(true);
         toast({ title: 'Успешно!', description: authMode === 'register' ? 'Регистрация завершена' : 'Вход выполнен' });
@@ -170,7 +327,7 @@ const Index = () => {
       const response = await api.sendMessage(currentUser.id, selectedChat.id, messageText);
       if (response.success) {
         setMessageText('');
-        loadMessages(selectedChat.id);
+        syncMessages(selectedChat.id);
         loadChats();
       } else {
         toast({ title: 'Ошибка', description: response.error, variant: 'destructive' });
@@ -185,21 +342,16 @@ const Index = () => {
     if (!file || !selectedChat || !currentUser) return;
 
     try {
-      const reader = new FileReader();
-      reader.onload = async () => {
-        const base64 = reader.result?.toString().split(',')[1];
-        if (base64) {
-          const uploadResponse = await api.uploadFile(currentUser.id, base64, file.name, file.type);
-          if (uploadResponse.success) {
-            const messageType = file.type.startsWith('image/') ? 'image' : 'file';
-            await api.sendMessage(currentUser.id, selectedChat.id, file.name, messageType, uploadResponse.file_url);
-            loadMessages(selectedChat.id);
-            loadChats();
-            toast({ title: 'Успешно!', description: 'Файл отправлен' });
-          }
-        }
-      };
-      reader.readAsDataURL(file);
+      const uploadResponse = await api.uploadFileDirect(currentUser.id, file);
+      if (uploadResponse.success) {
+        const messageType = file.type.startsWith('image/') ? 'image' : 'file';
+        await api.sendMessage(currentUser.id, selectedChat.id, file.name, messageType, uploadResponse.file_url, uploadResponse.file_id);
+        syncMessages(selectedChat.id);
+        loadChats();
+        toast({ title: 'Успешно!', description: 'Файл отправлен' });
+      } else {
+        toast({ title: 'Ошибка', description: uploadResponse.error, variant: 'destructive' });
+      }
     } catch (error) {
       toast({ title: 'Ошибка', description: 'Не удалось загрузить файл', variant: 'destructive' });
     }
@@ -240,6 +392,17 @@ const Index = () => {
     }
   };
 
+  const handleLogout = async () => {
+    try {
+      await api.logout();
+    } catch (error) {
+      console.error('Failed to revoke session:', error);
+    }
+    session.clear();
+    setShowProfileDialog(false);
+    resetSession();
+  };
+
   const handleUpdateProfile = async () => {
     if (!currentUser) return;
     
@@ -554,7 +717,7 @@ const Index = () => {
                   <p className="text-sm text-muted-foreground truncate">{chat.last_message}</p>
                 </div>
                 {chat.unread_count > 0 && (
-                  <Badge className="rounded-full">{chat.unread_count}</Badge>
+                  <Badge className="rounded-full">{chat.unread_count >= 100 ? '99+' : chat.unread_count}</Badge>
                 )}
               </button>
             ))}
@@ -575,7 +738,9 @@ const Index = () => {
                 </Avatar>
                 <div>
                   <h2 className="font-semibold">{selectedChat.name}</h2>
-                  {selectedChat.online ? (
+                  {typingUserIds.length > 0 ? (
+                    <p className="text-sm text-primary">печатает…</p>
+                  ) : selectedChat.online ? (
                     <p className="text-sm text-green-500">онлайн</p>
                   ) : selectedChat.status_text || selectedChat.status_emoji ? (
                     <p className="text-sm text-muted-foreground">
@@ -642,6 +807,13 @@ const Index = () => {
 
             <ScrollArea className="flex-1 p-4">
               <div className="space-y-4 max-w-3xl mx-auto">
+                {olderMessagesCursor && (
+                  <div className="flex justify-center">
+                    <Button variant="ghost" size="sm" onClick={loadOlderMessages}>
+                      Загрузить ранние сообщения
+                    </Button>
+                  </div>
+                )}
                 {messages.map((message) => (
                   <div
                     key={message.id}
@@ -659,7 +831,15 @@ const Index = () => {
                       )}
                       
                       {message.type === 'image' && message.file_url && (
-                        <img src={message.file_url} alt="Изображение" className="rounded-lg max-w-xs mb-2" />
+                        <a href={message.file_url} target="_blank" rel="noopener noreferrer">
+                          <img
+                            src={message.preview?.thumbnails['320'] || message.file_url}
+                            alt="Изображение"
+                            loading="lazy"
+                            className="rounded-lg max-w-xs mb-2 bg-cover"
+                            style={message.preview ? { backgroundImage: `url(${message.preview.placeholder})` } : undefined}
+                          />
+                        </a>
                       )}
                       
                       {message.type === 'file' && message.file_url && (
@@ -696,7 +876,7 @@ const Index = () => {
                 <Input
                   placeholder="Написать сообщение..."
                   value={messageText}
-                  onChange={(e) => setMessageText(e.target.value)}
+                  onChange={(e) => handleMessageTextChange(e.target.value)}
                   onKeyPress={(e) => e.key === 'Enter' && handleSendMessage()}
                   className="flex-1"
                 />
@@ -769,6 +949,10 @@ const Index = () => {
             <Button onClick={handleUpdateProfile} className="w-full">
               Сохранить
             </Button>
+            <Button onClick={handleLogout} variant="outline" className="w-full">
+              <Icon name="LogOut" size={16} className="mr-2" />
+              Выйти
+            </Button>
           </div>
         </DialogContent>
       </Dialog>